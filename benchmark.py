@@ -0,0 +1,295 @@
+import re
+import os
+import json
+import time
+import sqlite3
+import argparse
+import resource
+from statistics import median
+from types import SimpleNamespace as sn
+from nl2sql.db import ConnectionPool, Budget, execute
+from nl2sql.cache import db_fingerprint, sql_template
+from nl2sql.advisor import percentile
+from nl2sql.fts import find_fts, rewrite
+from nl2sql.lint import lint, load_schema
+from nl2sql.store import read_records
+
+
+def load_truth(path):
+    with open(path, "r") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    return [sn(source="truth", case=case["key"], sql=case["sql"]) for case in cases]
+
+
+def load_model_sql(paths):
+    queries = []
+    for path in paths:
+        if path.endswith(".jsonl"):
+            queries += [
+                sn(source=record["model"], case=record["case"], sql=record["sql"])
+                for record in read_records(path)
+            ]
+            continue
+        with open(path, "r") as f:
+            case = None
+            for line in f:
+                if line.startswith("CASE: "):
+                    case = line[len("CASE: ") :].strip()
+                elif match := re.match(r"LLM \[(.+?)\]: (.*)", line):
+                    queries.append(
+                        sn(source=match.group(1), case=case, sql=match.group(2))
+                    )
+    return [q for q in queries if q.sql.strip() and q.sql != "--timeout--"]
+
+
+def run(conn, query, repeat, timeout):
+    times = []
+    for _ in range(repeat):
+        budget = Budget(timeout=timeout)
+        time_a = time.perf_counter()
+        try:
+            with budget.watch(conn):
+                result = execute(conn, query.executed)
+            error = None
+        except sqlite3.Error as e:
+            result, error = None, str(e)
+        times.append(time.perf_counter() - time_a)
+        if error:
+            # failing statements fail the same way every time
+            break
+
+    return {
+        "source": query.source,
+        "case": query.case,
+        "template": query.template,
+        "sql": query.sql,
+        "fts_sql": query.executed if query.executed != query.sql else None,
+        "time": median(times),
+        "times": times,
+        "steps": budget.steps,
+        "rows": result and result.row_count,
+        "fingerprint": result and result.hexdigest(),
+        "error": error,
+        "cut_off": budget.cut_off,
+        "lint_errors": query.lint_errors,
+    }
+
+
+def summarize(times):
+    return {
+        "queries": len(times),
+        "total": sum(times),
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p99": percentile(times, 99),
+        "max": max(times) if times else None,
+    }
+
+
+def benchmark(db_path, queries, repeat=3, timeout=10, replica=None, fts=False):
+    # all queries of a case share the template of its ground truth, so
+    # model SQL is grouped by the question it answers
+    templates = {q.case: sql_template(q.sql) for q in queries if q.source == "truth"}
+    for query in queries:
+        query.template = templates.get(query.case) or sql_template(query.sql)
+
+    pool = ConnectionPool(db_path, size=1, replica=replica)
+    time_a = time.perf_counter()
+    with pool, pool.connection() as conn:
+        connect_time = time.perf_counter() - time_a
+        indexes = find_fts(conn) if fts else {}
+        schema = load_schema(conn)
+        for query in queries:
+            query.executed = rewrite(query.sql, indexes, schema)
+            query.lint_errors = lint(query.sql, schema).errors
+        results = [run(conn, query, repeat, timeout) for query in queries]
+
+    by_source = {}
+    by_template = {}
+    for result in results:
+        by_source.setdefault(result["source"], []).append(result["time"])
+        by_template.setdefault(result["template"], []).append(result["time"])
+
+    return {
+        "db": {
+            "path": db_path,
+            "fingerprint": db_fingerprint(db_path),
+            "size": os.path.getsize(db_path),
+            "replica": replica,
+            "sqlite": sqlite3.sqlite_version,
+            "fts": fts,
+        },
+        "repeat": repeat,
+        "timeout": timeout,
+        "connect_time": connect_time,
+        # ru_maxrss is in KiB on Linux and counts the mapped DB pages read
+        "peak_memory_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "errors": sum(1 for result in results if result["error"]),
+        "cut_off": sum(1 for result in results if result["cut_off"]),
+        # statements SQLite runs that main.py would reject before executing
+        "lint_false_positives": [
+            result
+            for result in results
+            if result["lint_errors"] and not result["error"]
+        ],
+        "summary": summarize([result["time"] for result in results]),
+        "sources": {source: summarize(times) for source, times in by_source.items()},
+        "templates": {
+            template: summarize(times) for template, times in by_template.items()
+        },
+        "queries": results,
+    }
+
+
+def print_report(report, top=10):
+    print(f"DB: {report['db']['path']} ({report['db']['fingerprint']})")
+    print(f"Peak memory: {report['peak_memory_mib']:.1f} MiB")
+    print(f"Errors: {report['errors']}, cut off: {report['cut_off']}")
+    false_positives = report["lint_false_positives"]
+    print(f"Lint false positives: {len(false_positives)}")
+    for result in false_positives[:top]:
+        print(f"  {'; '.join(result['lint_errors'])}  {result['sql']}")
+    for source, stats in [("all", report["summary"]), *report["sources"].items()]:
+        print(
+            f"{source:>16}: {stats['queries']:5} queries, total {stats['total']:.3f}s, "
+            f"p50 {stats['p50'] * 1000:.2f}ms, p90 {stats['p90'] * 1000:.2f}ms, "
+            f"p99 {stats['p99'] * 1000:.2f}ms, max {stats['max'] * 1000:.2f}ms"
+        )
+
+    print("Slowest templates by total time:")
+    templates = sorted(
+        report["templates"].items(), key=lambda item: item[1]["total"], reverse=True
+    )
+    for template, stats in templates[:top]:
+        print(
+            f"  {stats['total']:8.3f}s {stats['queries']:4}x "
+            f"p50 {stats['p50'] * 1000:8.2f}ms  {template}"
+        )
+
+
+def compare(base_path, new_path, top=10):
+    with open(base_path, "r") as f:
+        base = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+
+    def ratio(a, b):
+        return f"{a / b:.2f}x" if b else "-"
+
+    print(f"Base: {base['db']['path']} ({base['db']['fingerprint']})")
+    print(f"New:  {new['db']['path']} ({new['db']['fingerprint']})")
+    for key in ["total", "p50", "p90", "p99", "max"]:
+        a, b = base["summary"][key], new["summary"][key]
+        print(f"{key:>6}: {a:.4f}s -> {b:.4f}s ({ratio(a, b)} faster)")
+    print(
+        f"Peak memory: {base['peak_memory_mib']:.1f} MiB -> "
+        f"{new['peak_memory_mib']:.1f} MiB"
+    )
+
+    # the same statements must give the same results on both builds
+    base_queries = {(q["source"], q["case"], q["sql"]): q for q in base["queries"]}
+    changed = [
+        q
+        for q in new["queries"]
+        if (key := (q["source"], q["case"], q["sql"])) in base_queries
+        and base_queries[key]["fingerprint"] != q["fingerprint"]
+    ]
+    print(f"Results changed: {len(changed)}")
+
+    shared = [t for t in new["templates"] if t in base["templates"]]
+    shared.sort(
+        key=lambda t: base["templates"][t]["total"] - new["templates"][t]["total"],
+        reverse=True,
+    )
+    print("Templates with the largest change in total time:")
+    for template in shared[:top]:
+        a, b = base["templates"][template]["total"], new["templates"][template]["total"]
+        print(f"  {a:8.3f}s -> {b:8.3f}s ({ratio(a, b)})  {template}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SQL workload")
+
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="db/database_full.db",
+        help="DB build to benchmark",
+    )
+
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="dataset/test.json",
+        help="Test set whose ground truth SQL is replayed",
+    )
+
+    parser.add_argument(
+        "--model_sql",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Logs (output/*.log) or JSONL results to replay model SQL from",
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per query, the median is reported",
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        help="Seconds after which a query is cut off",
+    )
+
+    parser.add_argument(
+        "--replica",
+        type=str,
+        choices=["shared", "private"],
+        default=None,
+        help="Benchmark an in-memory replica instead of the DB file",
+    )
+
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="JSON report path, output/benchmark_<db>.json by default",
+    )
+
+    parser.add_argument(
+        "--compare",
+        type=str,
+        nargs=2,
+        metavar=("BASE", "NEW"),
+        help="Compare two JSON reports instead of running the benchmark",
+    )
+
+    parser.add_argument(
+        "--fts",
+        action="store_true",
+        help="Serve LIKE '%%...%%' from the FTS5 indexes of the DB, as main.py does",
+    )
+
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        queries = load_truth(args.dataset) + load_model_sql(args.model_sql)
+        report = benchmark(
+            args.db, queries, args.repeat, args.timeout, args.replica, args.fts
+        )
+        print_report(report)
+
+        out = args.out or os.path.join(
+            "output", f"benchmark_{os.path.splitext(os.path.basename(args.db))[0]}.json"
+        )
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        with open(out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark has been saved to {out}.")
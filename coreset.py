@@ -0,0 +1,218 @@
+import os
+import json
+import sqlite3
+import argparse
+from types import SimpleNamespace as sn
+from nl2sql.cache import sql_template
+from nl2sql.loader import CaseIndex
+from nl2sql.lint import tokenize, collect_tables, load_schema
+from nl2sql.store import read_results, is_correct
+
+AGGREGATES = {"COUNT", "AVG", "MIN", "MAX", "SUM"}
+CLAUSES = {"DISTINCT", "GROUP", "ORDER", "LIMIT", "HAVING", "LIKE", "IN", "BETWEEN"}
+OPERATORS = {"=", "<", ">", "<=", ">=", "!=", "<>"}
+
+
+def features(sql, schema):
+    """What a case exercises, from its ground truth SQL.
+
+    The SQL template (values replaced by ?), the tables it touches, the
+    number of joins, aggregations, clauses and comparison operators.
+    """
+    tokens = tokenize(sql)
+    values = [token.value for token in tokens]
+    aliases, _, _ = collect_tables(tokens, schema)
+    tables = {table for table in aliases.values() if table is not None}
+
+    found = {f"template:{sql_template(sql)}", f"joins:{max(0, len(tables) - 1)}"}
+    found |= {f"table:{table}" for table in tables}
+    for i, value in enumerate(values):
+        upper = value.upper()
+        if upper in AGGREGATES and i + 1 < len(values) and values[i + 1] == "(":
+            found.add(f"aggregate:{upper}")
+        elif upper in CLAUSES:
+            found.add(upper.lower())
+        elif value in OPERATORS:
+            found.add(f"operator:{value}")
+    if values.count("SELECT") > 1:
+        found.add("subquery")
+    return frozenset(found)
+
+
+def distance(a, b):
+    return 1 - len(a & b) / len(a | b)
+
+
+def select(cases, size):
+    """Pick ``size`` representative cases, weighted by what they stand for.
+
+    Centers are chosen farthest-first (k-center) over the Jaccard distance of
+    the case features, every case is assigned to its closest center, and each
+    center is then replaced by the medoid of its cluster. A chosen case
+    carries the size of its cluster as its weight.
+    """
+    size = min(size, len(cases))
+    # the first case of the persisted order starts, so the pick is stable
+    centers = [0]
+    closest = [distance(case.features, cases[0].features) for case in cases]
+    while len(centers) < size:
+        far = max(range(len(cases)), key=lambda i: closest[i])
+        if closest[far] == 0:
+            # fewer distinct cases than requested
+            break
+        centers.append(far)
+        for i, case in enumerate(cases):
+            closest[i] = min(closest[i], distance(case.features, cases[far].features))
+
+    def assign(centers):
+        clusters = {center: [] for center in centers}
+        for i, case in enumerate(cases):
+            center = min(
+                centers, key=lambda c: distance(case.features, cases[c].features)
+            )
+            clusters[center].append(i)
+        return clusters
+
+    medoids = [
+        min(
+            members,
+            key=lambda m: sum(
+                distance(cases[m].features, cases[o].features) for o in members
+            ),
+        )
+        for members in assign(centers).values()
+    ]
+    clusters = assign(medoids)
+    return [
+        sn(case=cases[center], weight=len(members), members=members)
+        for center, members in clusters.items()
+        if members
+    ]
+
+
+def weighted_accuracy(records, weights):
+    correct = sum(weights[record["case"]] * is_correct(record) for record in records)
+    total = sum(weights[record["case"]] for record in records)
+    return correct / total if total else None
+
+
+def evaluate(selected, paths):
+    # how well the coreset reproduces the accuracy of full runs on disk
+    weights = {item.case.key: item.weight for item in selected}
+    by_model = {}
+    for path in paths:
+        for record in read_results(path):
+            by_model.setdefault(record["model"], []).append(record)
+
+    report = {}
+    for model, records in by_model.items():
+        chosen = [record for record in records if record["case"] in weights]
+        report[model] = {
+            "cases": len({record["case"] for record in records}),
+            "accuracy": sum(map(is_correct, records)) / len(records),
+            "coreset_cases": len({record["case"] for record in chosen}),
+            "coreset_accuracy": (
+                sum(map(is_correct, chosen)) / len(chosen) if chosen else None
+            ),
+            "coreset_weighted_accuracy": weighted_accuracy(chosen, weights),
+        }
+    return report
+
+
+def percent(value):
+    return "-" if value is None else f"{value * 100:.1f}%"
+
+
+def ranking(report, key):
+    scored = [(model, stats[key]) for model, stats in report.items()]
+    scored = sorted(
+        (item for item in scored if item[1] is not None), key=lambda item: -item[1]
+    )
+    return ", ".join(model for model, _ in scored)
+
+
+def print_evaluation(report):
+    for model, stats in report.items():
+        print(
+            f"{model:>16}: full {percent(stats['accuracy'])} "
+            f"({stats['cases']} cases), coreset {percent(stats['coreset_accuracy'])} "
+            f"unweighted, {percent(stats['coreset_weighted_accuracy'])} weighted "
+            f"({stats['coreset_cases']} cases)"
+        )
+    print(f"Full ranking:    {ranking(report, 'accuracy')}")
+    print(f"Coreset ranking: {ranking(report, 'coreset_weighted_accuracy')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Select a weighted coreset of test cases"
+    )
+
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="dataset/test.json",
+        help="Test set to select from",
+    )
+
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=100,
+        help="Number of cases in the coreset",
+    )
+
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="db/database_full.db",
+        help="DB whose schema resolves the tables of the ground truth SQL",
+    )
+
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="Coreset path, dataset/<dataset>_coreset_<size>.json by default",
+    )
+
+    parser.add_argument(
+        "--results",
+        type=str,
+        nargs="*",
+        default=[],
+        help="JSONL results of full runs to compare the coreset accuracy with",
+    )
+
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    schema = load_schema(conn)
+    conn.close()
+
+    index = CaseIndex(args.dataset)
+    cases = [sn(**case) for case in index.iter()]
+    index.close()
+    for case in cases:
+        case.features = features(case.sql, schema)
+
+    selected = select(cases, args.size)
+    print(
+        f"Selected {len(selected)} of {len(cases)} cases from "
+        f"{len({case.features for case in cases})} distinct feature sets."
+    )
+
+    out = args.out or os.path.join(
+        os.path.dirname(args.dataset),
+        f"{os.path.splitext(os.path.basename(args.dataset))[0]}"
+        f"_coreset_{args.size}.json",
+    )
+    # same lines as the test set plus a weight, so get_data reads it as is
+    with open(out, "w") as f:
+        for item in selected:
+            case = {k: v for k, v in vars(item.case).items() if k != "features"}
+            f.write(json.dumps({**case, "weight": item.weight}) + "\n")
+    print(f"Coreset has been saved to {out}.")
+
+    if args.results:
+        print_evaluation(evaluate(selected, args.results))
@@ -1,7 +1,19 @@
 import pandas as pd
 import sqlite3
+import json
 import csv
+import re
+import time
+import random
+from statistics import median
 import os
+from nl2sql.cache import invalidate
+from nl2sql import duck
+from nl2sql.db import execute
+from nl2sql.fts import create_fts, rebuild_fts, find_fts, rewrite
+from nl2sql.lint import load_schema
+from nl2sql.values import read_values, write_values
+from nl2sql.advisor import load_workload, propose_indexes, create_index, time_workload
 
 # DEMO
 
@@ -18,6 +30,42 @@ patient_names = "db/mimic3_demo/id2name.csv"
 db_path = "db/database_full.db"
 ext = ".csv.gz"
 
+tables = [
+    "demographic",
+    "diagnoses",
+    "lab",
+    "prescriptions",
+    "procedures",
+]
+
+# ground truth SQL, optionally extended with logged model SQL from output/
+workload_paths = ["dataset/test.json"]
+index_report_path = "output/index_report.json"
+duckdb_path = "db/database_full.duckdb"
+# also load the prepared CSVs into duckdb_path, for main.py --engine duckdb
+build_duckdb = False
+text_index_report_path = "output/text_index_report.json"
+fts_report_path = "output/fts_report.json"
+# distinct text values for the value lookup main.py can put in the prompt
+values_path = "db/database_full.values.json"
+
+# text columns models compare through LOWER(), as prompts/system.md asks
+text_columns = {
+    "demographic": ["DIAGNOSIS", "NAME"],
+    "diagnoses": ["SHORT_TITLE", "LONG_TITLE"],
+    "procedures": ["SHORT_TITLE", "LONG_TITLE"],
+    "prescriptions": ["DRUG", "DRUG_TYPE", "ROUTE"],
+    "lab": ["LABEL", "FLUID", "CATEGORY", "FLAG"],
+}
+
+# free-text columns that LIKE '%...%' questions search, None to skip FTS5
+fts_columns = {
+    "diagnoses": ["LONG_TITLE"],
+    "procedures": ["SHORT_TITLE"],
+    "prescriptions": ["DRUG"],
+    "demographic": ["DIAGNOSIS"],
+}
+
 os.makedirs(output_path, exist_ok=True)
 
 
@@ -195,13 +243,7 @@ def process_lab():
 
 def recreate_db():
 
-    csv_files = [
-        "demographic",
-        "diagnoses",
-        "lab",
-        "prescriptions",
-        "procedures",
-    ]
+    csv_files = tables
 
     conn = sqlite3.connect(db_path)
 
@@ -223,8 +265,278 @@ def recreate_db():
 
         print(f"Inserted {results[0][0]} in {table}.")
 
+    for table, columns in (fts_columns or {}).items():
+        for column in columns:
+            name = create_fts(conn, table, column)
+            print(f"Created full-text index {name}.")
+    conn.commit()
+
+    conn.close()
+
+    # cached query results belong to the old DB; later stages that only add
+    # indexes change the DB fingerprint, so they invalidate it implicitly
+    invalidate(db_path)
+
+
+def recreate_duckdb():
+    # the same prepared CSVs through the same DataFrames as recreate_db, so
+    # both engines hold identical values and types
+    if os.path.exists(duckdb_path):
+        os.remove(duckdb_path)
+    conn = duck.connect(duckdb_path, read_only=False)
+
+    for table in tables:
+        df = pd.read_csv(os.path.join(output_path, table + ".csv"))
+        conn.register("df", df)
+        conn.execute(f'CREATE TABLE "{table}" AS SELECT * FROM df')
+        conn.unregister("df")
+
+        count = conn.execute(f'SELECT count(1) FROM "{table}"').fetchone()[0]
+        print(f"Inserted {count} in {table} (DuckDB).")
+
+    conn.close()
+
+
+def export_values():
+    conn = sqlite3.connect(db_path)
+    values = read_values(conn, text_columns)
+    conn.close()
+
+    write_values(values_path, values)
+    count = sum(len(column_values) for column_values in values.values())
+    print(f"Exported {count} distinct values to {values_path}.")
+
+
+def create_indexes():
+    conn = sqlite3.connect(db_path)
+
+    for table in tables:
+        for column in ["HADM_ID", "SUBJECT_ID"]:
+            conn.execute(
+                f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column.lower()}" '
+                f'ON "{table}" ( "{column}" )'
+            )
+            print(f"Created index on {table}.{column}.")
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def text_workload(conn, sample=10, seed=42):
+    # the predicates models write for the instruction to match lowercase,
+    # with real values, plus logged model SQL that uses them
+    rng = random.Random(seed)
+    queries = []
+    for table, columns in text_columns.items():
+        for column in columns:
+            values = [
+                value
+                for (value,) in conn.execute(
+                    f'SELECT DISTINCT "{column}" FROM "{table}" '
+                    f'WHERE "{column}" IS NOT NULL ORDER BY "{column}"'
+                )
+            ]
+            for value in rng.sample(values, min(sample, len(values))):
+                value = str(value).lower()
+                prefix = value[:4].replace("'", "''")
+                value = value.replace("'", "''")
+                queries += [
+                    f'SELECT COUNT(DISTINCT "SUBJECT_ID") FROM "{table}" '
+                    f"WHERE LOWER(\"{column}\") = '{value}'",
+                    f'SELECT COUNT(DISTINCT "SUBJECT_ID") FROM "{table}" '
+                    f"WHERE \"{column}\" LIKE '{prefix}%'",
+                ]
+                if table != "demographic":
+                    queries.append(
+                        f"SELECT AVG(d.AGE) FROM demographic d "
+                        f'JOIN "{table}" t ON d.HADM_ID = t.HADM_ID '
+                        f"WHERE LOWER(t.\"{column}\") = '{value}'"
+                    )
+
+    logged = load_workload([p for p in workload_paths if p.startswith("output")])
+    queries += [q for q in logged if re.search(r"LOWER\s*\(|LIKE", q, re.I)]
+    return queries
+
+
+def create_text_indexes(timeout=10):
+    conn = sqlite3.connect(db_path)
+    queries = text_workload(conn)
+
+    before = time_workload(conn, queries, timeout=timeout)
+    print(f"Before: {json.dumps(before)}")
+
+    # lower(col) expression indexes serve LOWER(col) = '...' and IN (...), the
+    # NOCASE ones serve col LIKE 'prefix%', which is case-insensitive in
+    # SQLite; the columns and their values stay exactly as they were
+    indexes = []
+    for table, columns in text_columns.items():
+        for column in columns:
+            name = f"idx_{table}_{column.lower()}"
+            indexes += [
+                f'CREATE INDEX IF NOT EXISTS "{name}_lower" '
+                f'ON "{table}" (lower("{column}"), "HADM_ID")',
+                f'CREATE INDEX IF NOT EXISTS "{name}_nocase" '
+                f'ON "{table}" ("{column}" COLLATE NOCASE)',
+            ]
+            print(f"Creating case-insensitive indexes on {table}.{column}.")
+    for index in indexes:
+        conn.execute(index)
+
+    conn.execute("ANALYZE")
+    conn.commit()
+
+    after = time_workload(conn, queries, timeout=timeout)
+    print(f"After: {json.dumps(after)}")
+    conn.close()
+
+    report = {
+        "columns": text_columns,
+        "indexes": indexes,
+        "queries": queries,
+        "before": before,
+        "after": after,
+    }
+    os.makedirs(os.path.dirname(text_index_report_path), exist_ok=True)
+    with open(text_index_report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Text index report has been saved to {text_index_report_path}.")
+
+
+# LIKE '%...%' as models write it; the unqualified LIKE over a derived table
+# must stay a plain LIKE, the outer rowid is not the inner table's
+fts_shapes = [
+    "SELECT COUNT(DISTINCT t.SUBJECT_ID) FROM {table} t "
+    "WHERE LOWER(t.{column}) LIKE '%{needle}%'",
+    "SELECT COUNT(*) FROM (SELECT * FROM {table}) WHERE {column} LIKE '%{needle}%'",
+]
+
+
+def benchmark_fts(sample=10, repeat=3, seed=42):
+    # substrings of real values, searched the way models write it
+    conn = sqlite3.connect(db_path)
+    schema = load_schema(conn)
+    indexes = find_fts(conn)
+    rng = random.Random(seed)
+
+    def run(sql):
+        times = []
+        for _ in range(repeat):
+            time_a = time.perf_counter()
+            result = execute(conn, sql)
+            times.append(time.perf_counter() - time_a)
+        return median(times), result.hexdigest()
+
+    results = []
+    for (table, column), name in indexes.items():
+        values = [
+            value
+            for (value,) in conn.execute(
+                f'SELECT DISTINCT "{column}" FROM "{table}" '
+                f'WHERE length("{column}") >= 5 ORDER BY "{column}"'
+            )
+        ]
+        for value in rng.sample(values, min(sample, len(values))):
+            start = rng.randrange(len(value) - 4)
+            needle = value[start : start + 5].lower().replace("'", "''")
+            for shape in fts_shapes:
+                sql = shape.format(table=table, column=column, needle=needle)
+                fts_sql = rewrite(sql, indexes, schema)
+                like_time, like_result = run(sql)
+                fts_time, fts_result = run(fts_sql)
+                results.append(
+                    {
+                        "index": name,
+                        "sql": sql,
+                        "fts_sql": fts_sql,
+                        "like": like_time,
+                        "fts": fts_time,
+                        "same_result": like_result == fts_result,
+                    }
+                )
+    conn.close()
+
+    for name in indexes.values():
+        rows = [r for r in results if r["index"] == name]
+        like_total = sum(r["like"] for r in rows)
+        fts_total = sum(r["fts"] for r in rows)
+        print(
+            f"{name}: LIKE {like_total * 1000:.1f}ms, FTS5 {fts_total * 1000:.1f}ms "
+            f"over {len(rows)} lookups, "
+            f"{sum(not r['same_result'] for r in rows)} with different results"
+        )
+
+    os.makedirs(os.path.dirname(fts_report_path), exist_ok=True)
+    with open(fts_report_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"FTS report has been saved to {fts_report_path}.")
+
+
+def cluster_table(conn, table, column):
+    # rewrite the table in `column` order so rows of one admission share pages
+    create_sql = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()[0]
+    index_sqls = [
+        row[0]
+        for row in conn.execute(
+            "SELECT sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+    ]
+
+    conn.execute(f'DROP TABLE IF EXISTS "{table}_clustered"')
+    conn.execute(create_sql.replace(f'"{table}"', f'"{table}_clustered"', 1))
+    conn.execute(
+        f'INSERT INTO "{table}_clustered" SELECT * FROM "{table}" ORDER BY "{column}"'
+    )
+    conn.execute(f'DROP TABLE "{table}"')
+    conn.execute(f'ALTER TABLE "{table}_clustered" RENAME TO "{table}"')
+    for index_sql in index_sqls:
+        conn.execute(index_sql)
+    rebuild_fts(conn, table)
+    conn.commit()
+    print(f"Clustered {table} by {column}.")
+
+
+def advise_indexes(cluster={"lab": "HADM_ID"}, sample=None, timeout=10):
+    queries = load_workload(workload_paths)[:sample]
+    conn = sqlite3.connect(db_path)
+
+    before = time_workload(conn, queries, timeout=timeout)
+    print(f"Before: {json.dumps(before)}")
+
+    indexes = propose_indexes(queries, set(tables))
+    for index in indexes:
+        print(f"Creating {index.name} on {index.table} {index.columns}.")
+        create_index(conn, index)
+
+    for table, column in cluster.items():
+        cluster_table(conn, table, column)
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("VACUUM")
+    rebuild_fts(conn)
+    conn.commit()
+
+    after = time_workload(conn, queries, timeout=timeout)
+    print(f"After: {json.dumps(after)}")
     conn.close()
 
+    report = {
+        "workload": workload_paths,
+        "indexes": [vars(index) for index in indexes],
+        "clustered": cluster,
+        "before": before,
+        "after": after,
+    }
+    os.makedirs(os.path.dirname(index_report_path), exist_ok=True)
+    with open(index_report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Index report has been saved to {index_report_path}.")
+
 
 if __name__ == "__main__":
     # subject_ids = process_demographic()
@@ -234,18 +546,10 @@ if __name__ == "__main__":
     process_lab()
 
     recreate_db()
-
-"""
-CREATE INDEX "idx_demographic_hadm_id" ON "demographic" ( "HADM_ID" );
-CREATE INDEX "idx_diagnoses_hadm_id" ON "diagnoses" ( "HADM_ID" );
-CREATE INDEX "idx_lab_hadm_id" ON "lab" ( "HADM_ID" );
-CREATE INDEX "idx_procedures_hadm_id" ON "procedures" ( "HADM_ID" );
-CREATE INDEX "idx_prescriptions_hadm_id" ON "prescriptions" ( "HADM_ID" );
-
-CREATE INDEX "idx_demographic_subject_id" ON "demographic" ( "SUBJECT_ID" );
-CREATE INDEX "idx_diagnoses_subject_id" ON "diagnoses" ( "SUBJECT_ID" );
-CREATE INDEX "idx_lab_subject_id" ON "lab" ( "SUBJECT_ID" );
-CREATE INDEX "idx_procedures_subject_id" ON "procedures" ( "SUBJECT_ID" );
-CREATE INDEX "idx_prescriptions_subject_id" ON "prescriptions" ( "HADM_ID" );
-
-"""
+    if build_duckdb:
+        recreate_duckdb()
+    export_values()
+    create_indexes()
+    create_text_indexes()
+    advise_indexes()
+    benchmark_fts()
@@ -6,6 +6,7 @@ from litellm import acompletion, aembedding
 import litellm
 import random
 import sys
+import time
 import asyncio
 from types import SimpleNamespace as sn
 import re
@@ -30,6 +31,7 @@ models = {
         meta=sn(
             price_in=0.90,
             price_out=0.90,
+            rate_limit=sn(rpm=600, tpm=None),
         ),
     ),
     "llama3.3-70b": sn(
@@ -37,6 +39,7 @@ models = {
         meta=sn(
             price_in=0.90,
             price_out=0.90,
+            rate_limit=sn(rpm=600, tpm=None),
         ),
     ),
     "gpt-4o": sn(
@@ -44,6 +47,7 @@ models = {
         meta=sn(
             price_in=2.50,
             price_out=10.00,
+            rate_limit=sn(rpm=5000, tpm=450000),
         ),
     ),
     # "deepseek-coder": sn(
@@ -59,6 +63,7 @@ models = {
             price_in=8.0,
             price_out=8.0,
             extra_tokens=10000,
+            rate_limit=sn(rpm=600, tpm=None),
         ),
     ),
     "deepseek-r1-groq": sn(
@@ -67,6 +72,7 @@ models = {
             price_in=8.0,
             price_out=8.0,
             extra_tokens=10000,
+            rate_limit=sn(rpm=30, tpm=6000),
         ),
     ),
 }
@@ -96,6 +102,93 @@ def parse_file(filename):
 prompts = parse_file("prompts/common_errors.md")
 
 
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def delay(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # a single request larger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+    def drain(self):
+        self.tokens = min(self.tokens, 0)
+
+
+class RateLimiter:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        async with self.lock:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if self.requests:
+                    delay = max(delay, self.requests.delay(1))
+                if self.tokens:
+                    delay = max(delay, self.tokens.delay(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+
+    def settle(self, estimated, actual):
+        if self.tokens:
+            self.tokens.take(actual - estimated)
+
+    def pause(self, seconds):
+        # the provider says we are over quota, so hold every request to it
+        # and let the buckets refill
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        if self.requests:
+            self.requests.drain()
+        if self.tokens:
+            self.tokens.drain()
+
+
+rate_limiters = {}
+
+
+def get_provider(model_spec):
+    if "/" in model_spec.model:
+        return model_spec.model.split("/", 1)[0]
+    return "openai"
+
+
+def get_rate_limiter(model_spec):
+    # models of a provider with the same limits share a quota (Fireworks
+    # limits the account), a model with limits of its own gets its own buckets
+    rate_limit = getattr(model_spec.meta, "rate_limit", None)
+    if rate_limit is None:
+        return None
+    key = (get_provider(model_spec), rate_limit.rpm, rate_limit.tpm)
+    if key not in rate_limiters:
+        rate_limiters[key] = RateLimiter(rate_limit.rpm, rate_limit.tpm)
+    return rate_limiters[key]
+
+
+def estimate_tokens(messages, max_tokens):
+    # roughly 4 characters per token for the prompt plus the expected
+    # completion tokens
+    return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+
 def get_models(include_large=False, models_filter=None):
     return [
         key
@@ -105,12 +198,28 @@ def get_models(include_large=False, models_filter=None):
     ]
 
 
+def cost(model, prompt_tokens, completion_tokens):
+    # dollars, prices are per million tokens
+    meta = models[model].meta
+    return (prompt_tokens * meta.price_in + completion_tokens * meta.price_out) / 10**6
+
+
 def normalize(x):
     if x:
         return re.sub(r"\s+", " ", x).strip()
     return x
 
 
+def format_values(values):
+    # candidates from nl2sql.values.ValueIndex.candidates for the question
+    lines = [f"- {value.table}.{value.column}: {value.value}" for value in values]
+    return (
+        "[values]\n"
+        "Values stored in the database that are close to phrases of the "
+        "question, spelled as stored:\n" + "\n".join(lines)
+    )
+
+
 async def ai_embeddings(inputs=[]):
     if len(inputs) == 0:
         return {"data": []}
@@ -131,6 +240,7 @@ async def ai_query(
     prefix=None,
     exclude_system_sections={},
     sql=True,
+    values=None,
 ):
     if system is None:
         system = "".join(
@@ -138,9 +248,15 @@ async def ai_query(
             for section, content in prompts.items()
             if section not in exclude_system_sections
         )
+        if values and "values" not in exclude_system_sections:
+            system += "\n\n" + format_values(values)
 
     model_spec = models.get(model)
 
+    # the reasoning budget is left out of the rate limit estimate, real usage
+    # is settled after the call
+    completion_tokens = max_tokens
+
     if hasattr(model_spec, "meta") and hasattr(model_spec.meta, "extra_tokens"):
         max_tokens += model_spec.meta.extra_tokens
 
@@ -170,14 +286,34 @@ async def ai_query(
         # "timeout": TIMEOUT,
     }
 
+    rate_limiter = get_rate_limiter(model_spec)
+    estimated_tokens = estimate_tokens(messages, completion_tokens)
+
     response = None
     for retry_idx in range(RETRY_LIMIT):
+        if rate_limiter:
+            await rate_limiter.acquire(estimated_tokens)
         try:
             response = await acompletion(**params)
-            break
+        except litellm.RateLimitError as e:
+            print(f"ERROR: ({model}) {str(e)}", file=sys.stderr)
+            if rate_limiter:
+                rate_limiter.settle(estimated_tokens, 0)
+                rate_limiter.pause(2**retry_idx)
+            else:
+                await asyncio.sleep((1.5 + retry_idx) ** 2 + random.uniform(0.5, 3))
         except Exception as e:
             print(f"ERROR: ({model}) {str(e)}", file=sys.stderr)
+            if rate_limiter:
+                rate_limiter.settle(estimated_tokens, 0)
             await asyncio.sleep((1.5 + retry_idx) ** 2 + random.uniform(0.5, 3))
+        else:
+            if rate_limiter:
+                usage = response.usage
+                rate_limiter.settle(
+                    estimated_tokens, usage.prompt_tokens + usage.completion_tokens
+                )
+            break
 
     if response and len(response.choices):
         result = response.choices[0].message.content
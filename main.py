@@ -1,5 +1,7 @@
-import json
-import threading
+import os
+import re
+import glob
+import argparse
 import random
 import datetime as dt
 import asyncio
@@ -9,14 +11,120 @@ import time
 from itertools import islice
 from pprint import pprint
 from types import SimpleNamespace as sn
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from nl2sql.db import ConnectionPool, Budget, MMAP_SIZE, CACHE_SIZE, ROW_CAP, execute
+from nl2sql.cache import ResultCache
+from nl2sql.duck import DuckBackend
+from nl2sql.loader import CaseIndex
+from nl2sql.plan import explain, classify, is_rejected
+from nl2sql.lint import lint, load_schema
+from nl2sql.fts import find_fts, rewrite
+from nl2sql.templates import TemplateCache, abstract
+from nl2sql.values import ValueIndex
+from nl2sql.sequential import SequentialStop
+from nl2sql.store import (
+    ResultStore,
+    read_take,
+    is_failed,
+    read_stops,
+    write_stop,
+    render_case,
+    is_correct,
+)
 
 db_path = "db/database_full.db"
+duckdb_path = "db/database_full.duckdb"
+db_engine = "sqlite"  # "sqlite" or "duckdb" (etl.py with build_duckdb = True)
+db_shadow_engine = None  # also run every query on this engine and compare
+sql_workers = 4
+db_pool_size = sql_workers
+db_mmap_size = MMAP_SIZE
+db_cache_size = CACHE_SIZE
+db_replica = None  # None (disk), "shared" or "private" in-memory copy
+sql_row_cap = ROW_CAP
+# SQLite VM steps per statement, a load-independent limit of roughly 5-10s of
+# work; the wall-clock timeout only catches what the step count cannot
+sql_step_budget = 250_000_000
+sql_timeout = 20
+plan_guard = "flag"  # "off", "flag" or "reject" model SQL by its query plan
+plan_reject_from = "unindexed_join"  # least severe plan class that is rejected
+# "off", "flag" or "reject" model SQL with unknown names; flag until
+# benchmark.py reports no lint false positives on the logged workload
+schema_lint = "flag"
+sql_cache = True  # reuse results of statements already run against this DB
+sql_fts = True  # serve LIKE '%...%' from the FTS5 indexes etl.py built, if any
+# answer questions of a template whose SQL was verified before without the
+# LLM: "off", "observe" (only check what the cache would answer) or "serve";
+# opt-in with --template_cache, see TemplateCache for the hit rate on MIMICSQL
+template_cache_mode = "off"
+template_cache_path = "output/template_cache.json"
+template_min_support = 2  # verified answers before a template is served
+# list stored values close to phrases of the question in the prompt, from the
+# lookup etl.py exports
+value_hints = False
+values_path = "db/database_full.values.json"
+# ask the cheapest model first and escalate only SQL that fails the local
+# checks; runs as one more model, "cascade", next to those in models_filter
+cascade = False
+cascade_stages = None  # models in order, None for the cheapest then the fallback
+cascade_fallback = "gpt-4o"
+# stop running a model once its accuracy is known to ±early_stop_precision, or
+# once its difference to every other model is decided at ±early_stop_margin
+early_stop_precision = None
+early_stop_margin = None
+early_stop_confidence = 0.95
+early_stop_step = 25  # answered cases between two looks at the intervals
 filter_case = None
+# dataset/<data_source>.json, e.g. a weighted coreset written by coreset.py
+data_source = "test"
 
 random.seed(42)
 
 
+def open_resources():
+    global db_pool, sql_executor, db_schema, fts_indexes, db_columns
+    global result_cache, template_cache, value_index, duck_backend
+
+    db_pool = ConnectionPool(
+        db_path,
+        size=db_pool_size,
+        mmap_size=db_mmap_size,
+        cache_size=db_cache_size,
+        replica=db_replica,
+    )
+    # sqlite3 releases the GIL while a statement runs, so threads are enough to
+    # keep slow queries off the event loop
+    sql_executor = ThreadPoolExecutor(max_workers=sql_workers, thread_name_prefix="sql")
+    with db_pool.connection() as conn:
+        db_schema = load_schema(conn)
+        fts_indexes = find_fts(conn) if sql_fts else {}
+    result_cache = (
+        ResultCache(db_path, sql_row_cap, sql_step_budget) if sql_cache else None
+    )
+    db_columns = set().union(*db_schema.values())
+    template_cache = (
+        TemplateCache(template_cache_path, db_columns, template_min_support)
+        if template_cache_mode != "off"
+        else None
+    )
+    value_index = ValueIndex.load(values_path) if value_hints else None
+    duck_backend = (
+        DuckBackend(duckdb_path) if "duckdb" in (db_engine, db_shadow_engine) else None
+    )
+
+
+def close_resources():
+    sql_executor.shutdown()
+    db_pool.close()
+    tqdm.write(f"DB pool: {db_pool}")
+    if duck_backend is not None:
+        duck_backend.close()
+    if result_cache is not None:
+        result_cache.close()
+        tqdm.write(f"SQL cache: {result_cache}")
+
+
 class LogOutput:
     def __init__(self, file_path):
         self.log_file = open(file_path, "a")
@@ -39,185 +147,1052 @@ def logger(file_path):
     return log
 
 
-def get_data(source="test", continue_from=None, filter_case=None):
-    with open(f"dataset/{source}.json", "r") as f:
-        lines = []
-        while (line := f.readline()) != "":
-            data = json.loads(line)
+def get_data(source="test", continue_from=None, filter_case=None, start=0):
+    cases = CaseIndex(f"dataset/{source}.json")
+    try:
+        if filter_case is not None:
+            yield cases.get(filter_case)
+            return
 
-            if filter_case is not None:
-                if data.get("key") == filter_case:
-                    lines.append(data)
-            else:
-                lines.append(data)
+        if continue_from:
+            start = cases.position(continue_from)
 
-        lines = list(reversed(lines))
-        random.shuffle(lines)
+        yield from cases.iter(start)
+    finally:
+        cases.close()
+
+
+def execute_sql(sql, timeout=sql_timeout):
+    result = sn(
+        first_row=None,
+        row_count=None,
+        truncated=False,
+        fingerprint=None,
+        error=None,
+        elapsed=None,
+        cached=False,
+        steps=None,
+        cut_off=None,
+    )
+    budget = Budget(sql_step_budget, timeout)
+    time_a = time.monotonic()
+
+    try:
+        with db_pool.connection() as conn, budget.watch(conn):
+            fingerprint = execute(conn, sql, row_cap=sql_row_cap)
+        result.first_row = fingerprint.first_row
+        result.row_count = fingerprint.row_count
+        result.truncated = fingerprint.truncated
+        result.fingerprint = fingerprint.hexdigest()
+    except sqlite3.Error as e:
+        print("Error: ", e)
+        result.error = str(e)
+
+    result.elapsed = time.monotonic() - time_a
+    result.steps = budget.steps
+    result.cut_off = budget.cut_off
+    return result
 
-        index = 0
-        if continue_from:
-            index = [x.get("key") for x in lines].index(continue_from)
 
-        for line in lines[index:]:
-            yield line
+def run_engine(engine, sql, timeout=sql_timeout):
+    if engine == "duckdb":
+        return duck_backend.query(sql, timeout, row_cap=sql_row_cap)
+    if result_cache is not None:
+        # elapsed stays the time of the run that filled the cache
+        return result_cache.run(sql, lambda: execute_sql(sql, timeout))
+    return execute_sql(sql, timeout)
 
 
-def query(sql, timeout=10):
+def query(sql, timeout=sql_timeout, guard=False):
+    result = sn(
+        first_row=None,
+        row_count=None,
+        truncated=False,
+        fingerprint=None,
+        error=None,
+        elapsed=None,
+        cached=False,
+        steps=None,
+        cut_off=None,
+        dialect=None,
+        fts_sql=None,
+        plan=None,
+        lint=None,
+        rejected=None,
+    )
+    time_a = time.monotonic()
 
-    conn = sqlite3.connect(db_path)
-    timer = threading.Timer(timeout, lambda: conn.interrupt())
-    cursor = conn.cursor()
     try:
-        timer.start()
-        cursor.execute(sql)
-        results = cursor.fetchall()
-        return results
+        if guard and schema_lint != "off":
+            # unknown tables and columns are caught without touching the DB
+            result.lint = lint(sql, db_schema)
+            if schema_lint == "reject" and not result.lint.ok:
+                result.rejected = "schema"
+                result.error = "; ".join(result.lint.errors)
+                result.elapsed = time.monotonic() - time_a
+                return result
+
+        if fts_indexes and db_engine == "sqlite":
+            # same rows, only the substring lookup goes through the index
+            fts_sql = rewrite(sql, fts_indexes, db_schema)
+            if fts_sql != sql:
+                result.fts_sql = sql = fts_sql
+
+        if guard and plan_guard != "off" and db_engine == "sqlite":
+            with db_pool.connection() as conn:
+                result.plan = classify(explain(conn, sql), sql)
+            if plan_guard == "reject" and is_rejected(
+                result.plan.plan_class, plan_reject_from
+            ):
+                result.rejected = "plan"
+                result.error = f"rejected by plan guard: {result.plan.plan_class}"
+                result.elapsed = time.monotonic() - time_a
+                return result
+
+        vars(result).update(vars(run_engine(db_engine, sql, timeout)))
     except sqlite3.OperationalError as e:
         print("Error: ", e)
-        return None
+        result.error = str(e)
+        result.elapsed = time.monotonic() - time_a
     except Exception as e:
         print("Error: ", e)
+        result.error = str(e)
+        result.elapsed = time.monotonic() - time_a
+
+    return result
+
+
+async def run_query(sql, guard=False):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(sql_executor, query, sql, sql_timeout, guard)
+
+
+async def run_shadow(sql, result):
+    # SQL the linter rejected never reaches either engine
+    if db_shadow_engine is None or result.rejected == "schema":
         return None
-    finally:
-        timer.cancel()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        sql_executor, run_engine, db_shadow_engine, sql, sql_timeout
+    )
 
 
-async def gather_tasks(tasks: dict):
-    keys = list(tasks.keys())
-    values = await asyncio.gather(*tasks.values())
-    return dict(zip(keys, values))
+async def run_truth(sql):
+    truth = await run_query(sql)
+    return truth, await run_shadow(sql, truth)
 
 
-async def run_test_case(case, models, exclude_prompts):
-    tasks = {}
+async def run_model(case, model, exclude_prompts):
+    hit = template_cache and template_cache.lookup(
+        model, llm.normalize(case.question_refine)
+    )
     time_a = time.monotonic()
-    for model in models:
-        task = llm.ai_query(
+    if hit and template_cache_mode == "serve":
+        response = sn(
+            sql=hit.sql,
+            meta=sn(model="template", usage=sn(prompt_tokens=0, completion_tokens=0)),
+        )
+    else:
+        response = await llm.ai_query(
             message="Please convert this question to SQL: " + case.question_refine,
             model=model,
             max_tokens=len(case.sql) * 2,
             exclude_system_sections=exclude_prompts,
+            values=case.values,
         )
-        tasks[model] = task
+    response.llm_elapsed = time.monotonic() - time_a
+    response.values = case.values
+    response.template = hit
+    response.served = bool(hit) and template_cache_mode == "serve"
+    # executed as soon as this model answers, while the others are still running
+    response.result = await run_query(response.sql, guard=True)
+    response.shadow = await run_shadow(response.sql, response.result)
+    response.template_result = None
+    if hit:
+        response.template_result = (
+            response.result
+            if hit.sql == response.sql
+            else await run_query(hit.sql, guard=True)
+        )
+    return response
+
 
-    results = await gather_tasks(tasks)
-    time_b = time.monotonic()
+def get_cascade_stages():
+    if cascade_stages:
+        return cascade_stages
+    cheapest = min(
+        (model for model in llm.models if model != cascade_fallback),
+        key=lambda model: llm.cost(model, 1, 1),
+    )
+    return [cheapest, cascade_fallback]
+
+
+def validate(response):
+    # why the SQL of a cascade stage cannot be accepted, None when it can
+    result = response.result
+    if response.sql == "--timeout--":
+        return "no answer"
+    if result.rejected:
+        return result.rejected
+    # linted here too, query() only lints as far as schema_lint asks
+    if not (result.lint or lint(response.sql, db_schema)).ok:
+        return "schema"
+    if result.error:
+        return "parse" if "syntax error" in result.error else "error"
+    if result.cut_off:
+        return "cut off"
+    if not result.row_count or all(value is None for value in result.first_row):
+        return "empty"
+    return None
+
+
+def restore_response(record):
+    # the answer of an earlier, interrupted run, its SQL runs again (cached)
+    async def restore():
+        response = sn(
+            sql=record["sql"],
+            meta=sn(
+                model=record["model_name"],
+                usage=sn(
+                    prompt_tokens=record["usage"]["in"],
+                    completion_tokens=record["usage"]["out"],
+                ),
+            ),
+            llm_elapsed=record["timings"]["llm"],
+            values=None,
+            template=None,
+            served=False,
+            template_result=None,
+            shadow=None,
+        )
+        response.result = await run_query(response.sql, guard=True)
+        return response
 
-    if (time_b - time_a) < 2.0:
-        await asyncio.sleep(1)
+    return asyncio.ensure_future(restore())
 
-    return sn(
-        case=case,
-        output=results,
+
+async def run_cascade(case, exclude_prompts):
+    stages = []
+    for model in get_cascade_stages():
+        # a model that is part of the run answers the case anyway, its answer
+        # is shared instead of paying for the same call twice
+        response = None
+        if model in case.responses:
+            response = await case.responses[model]
+        reused = response is not None
+        if reused:
+            response = sn(**vars(response))
+        else:
+            response = await run_model(case, model, exclude_prompts)
+        usage = response.meta.usage
+        stages.append(
+            {
+                "model": model,
+                "sql": response.sql,
+                "reused": reused,
+                "rejected": validate(response),
+                "usage": {"in": usage.prompt_tokens, "out": usage.completion_tokens},
+                "cost": llm.cost(model, usage.prompt_tokens, usage.completion_tokens),
+                "timings": {
+                    "llm": response.llm_elapsed,
+                    "sql": response.result.elapsed,
+                },
+            }
+        )
+        if stages[-1]["rejected"] is None:
+            break
+
+    # the last answer stands, with the usage and time of every stage
+    response.llm_elapsed = sum(stage["timings"]["llm"] for stage in stages)
+    response.meta = sn(
+        model=response.meta.model,
+        usage=sn(
+            prompt_tokens=sum(stage["usage"]["in"] for stage in stages),
+            completion_tokens=sum(stage["usage"]["out"] for stage in stages),
+        ),
     )
+    response.cascade = stages
+    return response
+
+
+async def drain_queue(
+    model, queue, concurrency, exclude_prompts, on_result, stopper=None
+):
+    async def worker():
+        while (case := await queue.get()) is not None:
+            if stopper is not None and stopper.stopped(model):
+                # the rest of the queue is drained without calling the model
+                stopper.skip(model)
+                if model in case.responses:
+                    case.responses[model].set_result(None)
+                await on_result(case, model, None)
+                continue
+            if model == "cascade":
+                response = await run_cascade(case, exclude_prompts)
+            else:
+                response = await run_model(case, model, exclude_prompts)
+            if model in case.responses:
+                case.responses[model].set_result(response)
+            await on_result(case, model, response)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def get_concurrency(model, default):
+    if model not in llm.models:
+        return default
+    return getattr(llm.models[model].meta, "concurrency", default)
+
+
+def format_answer(result):
+    if result.row_count:
+        return f"{result.first_row} ({result.row_count} rows)"
+    elif result.row_count == 0:
+        return []
+    else:
+        return None
+
+
+def make_shadow_record(response, truth, truth_shadow):
+    shadow = response.shadow
+    if shadow is None and truth_shadow is None:
+        return None
+    record = {"engine": db_shadow_engine}
+    for prefix, primary, other in [
+        ("", response.result, shadow),
+        ("truth_", truth, truth_shadow),
+    ]:
+        if other is None:
+            continue
+        record.update(
+            {
+                prefix + "fingerprint": other.fingerprint,
+                prefix + "elapsed": other.elapsed,
+                prefix + "error": other.error,
+                prefix + "dialect": getattr(other, "dialect", None),
+                prefix + "agree": other.fingerprint == primary.fingerprint,
+            }
+        )
+    return record
+
+
+def make_record(experiment_name, take, case, model, response, truth, truth_shadow=None):
+    return {
+        "experiment": experiment_name,
+        "take": take,
+        "case": llm.normalize(case.key),
+        "question": llm.normalize(case.question_refine),
+        "truth_sql": llm.normalize(case.sql),
+        # cases of the full test set this one stands for in a coreset
+        "weight": getattr(case, "weight", 1),
+        "model": model,
+        "model_name": response.meta.model,
+        "sql": response.sql,
+        "usage": {
+            "in": response.meta.usage.prompt_tokens,
+            "out": response.meta.usage.completion_tokens,
+        },
+        "answer": str(format_answer(response.result)),
+        "truth_answer": str(format_answer(truth)),
+        "rows": response.result.row_count,
+        "truth_rows": truth.row_count,
+        "truncated": response.result.truncated,
+        "truth_truncated": truth.truncated,
+        "fingerprint": response.result.fingerprint,
+        "truth_fingerprint": truth.fingerprint,
+        "timings": {
+            "llm": response.llm_elapsed,
+            "sql": response.result.elapsed,
+            "truth_sql": truth.elapsed,
+        },
+        "cached": response.result.cached,
+        "truth_cached": truth.cached,
+        "steps": response.result.steps,
+        "truth_steps": truth.steps,
+        "cut_off": response.result.cut_off,
+        "truth_cut_off": truth.cut_off,
+        "error": response.result.error,
+        "truth_error": truth.error,
+        "engine": db_engine,
+        "dialect": response.result.dialect,
+        "fts_sql": response.result.fts_sql,
+        "shadow": make_shadow_record(response, truth, truth_shadow),
+        "plan": response.result.plan and response.result.plan.plan_class,
+        "plan_reasons": response.result.plan and response.result.plan.reasons,
+        "plan_rejected": response.result.rejected == "plan",
+        "lint_errors": response.result.lint and response.result.lint.errors,
+        "lint_rejected": response.result.rejected == "schema",
+        "values": response.values
+        and [f"{v.table}.{v.column}: {v.value}" for v in response.values],
+        "cascade": getattr(response, "cascade", None),
+        "template": template_of(case),
+        "template_hit": response.template is not None,
+        "template_served": response.served,
+        "template_sql": response.template and response.template.sql,
+        "template_correct": response.template_result
+        and response.template_result.fingerprint is not None
+        and response.template_result.fingerprint == truth.fingerprint,
+    }
+
+
+def template_of(case):
+    # reported by the template of the ground truth, hit or not
+    template = abstract(llm.normalize(case.question_refine), case.sql, db_columns)
+    return template and template.question
+
+
+def learn_template(case, model, response, truth):
+    # only SQL the LLM wrote and that gives the ground truth result is learned
+    if (
+        template_cache is None
+        or response.served
+        or truth.fingerprint is None
+        or truth.truncated
+        or response.result.fingerprint != truth.fingerprint
+    ):
+        return
+    if model == "cascade":
+        model = response.cascade[-1]["model"]
+    template_cache.learn(model, llm.normalize(case.question_refine), response.sql)
+
+
+def report_plans(records, timeout=sql_timeout):
+    stats = {}
+    for record in records:
+        if record["plan"] is None:
+            continue
+        entry = stats.setdefault(record["plan"], sn(count=0, rejected=0, elapsed=0.0))
+        entry.count += 1
+        if record["plan_rejected"]:
+            entry.rejected += 1
+        else:
+            entry.elapsed += record["timings"]["sql"]
+
+    for plan_class, entry in stats.items():
+        executed = entry.count - entry.rejected
+        line = f"Plan {plan_class}: {entry.count} queries"
+        if executed:
+            line += f", {entry.elapsed / executed:.3f}s average over {executed} run"
+        if entry.rejected:
+            line += (
+                f", {entry.rejected} rejected saving up to "
+                f"{entry.rejected * timeout:.0f}s"
+            )
+        tqdm.write(line)
+
+
+def report_engines(records):
+    stats = sn(count=0, agree=0, truth_count=0, truth_agree=0, failed=0)
+    elapsed = {db_engine: 0.0, db_shadow_engine: 0.0}
+    dialect = {}
+    for record in records:
+        shadow = record["shadow"]
+        if not shadow:
+            continue
+        if "fingerprint" in shadow:
+            stats.count += 1
+            stats.agree += shadow["agree"]
+            stats.failed += bool(shadow["error"]) and not record["error"]
+            elapsed[db_engine] += record["timings"]["sql"]
+            elapsed[db_shadow_engine] += shadow["elapsed"]
+            for note in shadow["dialect"] or record["dialect"] or []:
+                dialect[note] = dialect.get(note, 0) + 1
+        if "truth_fingerprint" in shadow:
+            stats.truth_count += 1
+            stats.truth_agree += shadow["truth_agree"]
+
+    if not stats.count:
+        return
+    tqdm.write(
+        f"Engines {db_engine} vs {db_shadow_engine}: model SQL agrees on "
+        f"{stats.agree}/{stats.count}, ground truth on "
+        f"{stats.truth_agree}/{stats.truth_count}, {stats.failed} failing only on "
+        f"{db_shadow_engine}; {elapsed[db_engine]:.2f}s vs "
+        f"{elapsed[db_shadow_engine]:.2f}s of model SQL"
+    )
+    for note, count in sorted(dialect.items(), key=lambda item: -item[1]):
+        tqdm.write(f"  dialect: {note} in {count} queries")
+
+
+def report_lint(records):
+    stats = {}
+    for record in records:
+        if record["lint_errors"]:
+            entry = stats.setdefault(record["model"], sn(count=0, rejected=0))
+            entry.count += 1
+            entry.rejected += record["lint_rejected"]
+
+    for model, entry in stats.items():
+        tqdm.write(
+            f"Schema lint {model}: {entry.count} queries with unknown names, "
+            f"{entry.rejected} rejected before execution"
+        )
+
+
+def report_templates(records, top=10):
+    stats = {}
+    by_template = {}
+    for record in records:
+        if record.get("template_hit") is None:
+            continue
+        entry = stats.setdefault(
+            record["model"], sn(count=0, hits=0, correct=0, served=0, tokens=[])
+        )
+        entry.count += 1
+        entry.hits += record["template_hit"]
+        entry.correct += bool(record["template_correct"])
+        entry.served += record["template_served"]
+        if not record["template_served"]:
+            entry.tokens.append(record["usage"]["in"] + record["usage"]["out"])
+        if record["template"]:
+            template = by_template.setdefault(
+                record["template"], sn(count=0, hits=0, correct=0)
+            )
+            template.count += 1
+            template.hits += record["template_hit"]
+            template.correct += bool(record["template_correct"])
+
+    for model, entry in stats.items():
+        if not entry.hits:
+            continue
+        # tokens saved are estimated from the calls this run did make
+        tokens = sum(entry.tokens) / len(entry.tokens) if entry.tokens else 0
+        tqdm.write(
+            f"Template cache {model}: {entry.hits}/{entry.count} hits, "
+            f"{entry.correct}/{entry.hits} correct, {entry.served} calls and "
+            f"~{entry.served * tokens:,.0f} tokens saved"
+        )
+
+    templates = sorted(by_template.items(), key=lambda item: -item[1].hits)
+    for template, entry in templates[:top]:
+        if entry.hits:
+            tqdm.write(
+                f"  {entry.hits:4}/{entry.count:<4} hits {entry.correct:4} correct  "
+                f"{template}"
+            )
+
+
+def report_cascade(records):
+    def latency(record):
+        return record["timings"]["llm"] + (record["timings"]["sql"] or 0)
 
+    cascaded = [record for record in records if record.get("cascade")]
+    if not cascaded:
+        return
 
-def batch_iterator(iterable, batch_size=10):
-    batch = []
-    count = 0
-    for idx, item in enumerate(iterable):
-        batch.append((idx, item))
-        if len(batch) == batch_size:
-            yield count, batch
-            count += 1
-            batch = []
-    if batch:
-        yield count, batch
+    stages = {}
+    for record in cascaded:
+        for i, stage in enumerate(record["cascade"]):
+            entry = stages.setdefault(
+                i, sn(model=stage["model"], count=0, passed=0, reused=0, reasons={})
+            )
+            entry.count += 1
+            entry.reused += stage.get("reused", False)
+            if stage["rejected"] is None:
+                entry.passed += 1
+            else:
+                reason = stage["rejected"]
+                entry.reasons[reason] = entry.reasons.get(reason, 0) + 1
+    for i, entry in stages.items():
+        reasons = ", ".join(
+            f"{reason} {count}" for reason, count in entry.reasons.items()
+        )
+        tqdm.write(
+            f"Cascade stage {i + 1} {entry.model}: {entry.passed}/{entry.count} "
+            f"accepted, {entry.reused} answers shared with the run"
+            + (f" (escalated: {reasons})" if reasons else "")
+        )
+
+    def summary(name, records, cost):
+        tqdm.write(
+            f"  {name:>10}: {sum(map(is_correct, records))}/{len(records)} correct, "
+            f"${cost:.4f}, {sum(map(latency, records)) / len(records):.2f}s per case"
+        )
+
+    summary("cascade", cascaded, sum(map(record_cost, cascaded)))
+    # the baseline is the fallback on the same cases when it ran too
+    cases = {record["case"] for record in cascaded}
+    baseline = [
+        record
+        for record in records
+        if record["model"] == cascade_fallback and record["case"] in cases
+    ]
+    if baseline:
+        summary(
+            f"{cascade_fallback} only",
+            baseline,
+            sum(map(record_cost, baseline)),
+        )
+
+
+def record_cost(record):
+    if record.get("cascade"):
+        return sum(stage["cost"] for stage in record["cascade"])
+    if record["model"] not in llm.models:
+        return 0.0
+    return llm.cost(record["model"], record["usage"]["in"], record["usage"]["out"])
+
+
+def report_early_stop(stopper, records):
+    for model in stopper.models:
+        summary = stopper.summary(model)
+        if not summary.n:
+            continue
+        model_records = [record for record in records if record["model"] == model]
+        # the cases a model skipped would have cost what its answered ones did
+        cost = sum(map(record_cost, model_records)) / max(1, len(model_records))
+        tqdm.write(
+            f"Early stop {model}: {summary.correct}/{summary.n} correct, "
+            f"{summary.correct / summary.n:.3f} [{summary.low:.3f}, {summary.high:.3f}]"
+            f", {summary.reason or 'not stopped'}; {summary.skipped} calls and "
+            f"~${summary.skipped * cost:.4f} saved"
+        )
+
+
+def report_weighted(records):
+    by_model = {}
+    for record in records:
+        by_model.setdefault(record["model"], []).append(record)
+
+    for model, model_records in by_model.items():
+        total = sum(record["weight"] for record in model_records)
+        correct = sum(record["weight"] * is_correct(record) for record in model_records)
+        tqdm.write(
+            f"Reweighted accuracy {model}: {correct / total:.3f} over "
+            f"{len(model_records)} cases standing for {total}, "
+            f"{sum(map(is_correct, model_records)) / len(model_records):.3f} unweighted"
+        )
+
+
+def report_slow_queries(records, top=5):
+    by_model = {}
+    for record in records:
+        if record.get("steps") is not None:
+            by_model.setdefault(record["model"], []).append(record)
+
+    for model, model_records in by_model.items():
+        model_records.sort(key=lambda record: record["steps"], reverse=True)
+        cut_off = sum(1 for record in model_records if record["cut_off"])
+        tqdm.write(
+            f"Slowest SQL of {model} ({cut_off} of {len(model_records)} cut off):"
+        )
+        for record in model_records[:top]:
+            tqdm.write(
+                f"  {record['steps']:>12,} steps {record['timings']['sql']:7.3f}s "
+                f"{record['rows']} rows {record['cut_off'] or ''} "
+                f"[{record['case']}] {record['sql']}"
+            )
 
 
 async def main(
     experiment_name,
-    batch_size=10,
-    batch_limit=-1,
+    in_flight=10,
+    limit=1000,
     exclude_prompts={},
     continue_from=None,
     models_filter=None,
+    take=1,
+    text_log=True,
+    shard=None,
 ):
 
-    print = logger(f"output/output_{experiment_name}.log")
+    output_path = shard_path(experiment_name, shard)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    results_path = output_path + ".jsonl"
+    stops_path = output_path + ".stops.json"
+    done = read_take(results_path, take)
+    # failed answers are asked again, their retry replaces them on disk
+    completed = {
+        (record["case"], record["model"]) for record in done if not is_failed(record)
+    }
+
+    if text_log:
+        print = logger(output_path + ".log")
+    else:
+        print = lambda *args, **kwargs: None
 
-    if not continue_from:
+    if not continue_from and not completed:
         print()
         print("=" * 30)
         print()
         print(
-            f"Starting experiment {experiment_name} at {dt.datetime.now().isoformat()}..."
+            f"Starting experiment {experiment_name} at {dt.datetime.now().isoformat()} "
+            f"with {in_flight} cases in flight per model..."
         )
         print()
     models = llm.get_models(models_filter=models_filter)
+    if cascade:
+        models.append("cascade")
 
-    # 1000 test cases
-    for batch_id, batch in tqdm(
-        batch_iterator(
-            (sn(**x) for x in get_data("test", continue_from)),
-            batch_size=batch_size,
-        ),
-        total=batch_limit if batch_limit > 0 else 1000 // batch_size,
-    ):
-        if batch_id >= batch_limit:
-            break
+    if db_pool.replica:
+        db_pool.warm()
+        tqdm.write(f"DB pool: {db_pool}")
 
-        tasks = []
-        for _, case in batch:
-            tasks.append(run_test_case(case, models, exclude_prompts))
+    # every model drains its own queue, so a slow model never holds back the
+    # others; responses are joined per case only when the case gets logged.
+    # Queues are bounded, so only the cases in flight are held in memory
+    concurrency = {model: get_concurrency(model, in_flight) for model in models}
+    queues = {model: asyncio.Queue(maxsize=concurrency[model]) for model in models}
+    pending = {}
+    # answers of earlier runs the cascade can share, by (case, model)
+    restorable = (
+        {(record["case"], record["model"]): record for record in done}
+        if cascade
+        else {}
+    )
 
-        batch_results = await asyncio.gather(*tasks)
+    if completed:
+        tqdm.write(f"Resuming {experiment_name}: {len(completed)} results on disk")
 
-        def format_answer(data):
-            if data and len(data) > 0:
-                return f"{data[0]} ({len(data)} rows)"
-            else:
-                return data
-
-        for batch_result in batch_results:
-            print("*" * 30)
-            print()
-            print("CASE:", llm.normalize(batch_result.case.key))
-            print("QUESTION:", llm.normalize(batch_result.case.question_refine))
-            print()
-            print("TRUE:", llm.normalize(batch_result.case.sql))
-            truth = query(batch_result.case.sql)
-            print()
-
-            for model, response in batch_result.output.items():
-                print(f"LLM [{model}]:", response.sql)
-                data = query(response.sql)
-                print(f"MODEL:", response.meta.model)
-                usage = {
-                    "in": response.meta.usage.prompt_tokens,
-                    "out": response.meta.usage.completion_tokens,
-                }
-                print(f"USAGE:", json.dumps(usage))
-                print(
-                    "ANSWER:",
-                    format_answer(data),
-                    format_answer(truth),
+    store = ResultStore(results_path)
+    records = []
+    # the total grows as the producer reads cases
+    progress = tqdm(total=0)
+
+    stopper = None
+    if early_stop_precision is not None or early_stop_margin is not None:
+        stopper = SequentialStop(
+            models,
+            # the most cases this run can have, the test set is not counted
+            -(-limit // shard.count) if shard is not None else limit,
+            precision=early_stop_precision,
+            margin=early_stop_margin,
+            confidence=early_stop_confidence,
+            step=early_stop_step,
+        )
+        # a resumed run goes on from the outcomes on disk, and a model stopped
+        # before stays stopped instead of being asked about its skipped cases
+        stopper.restore(
+            [(record["model"], record["case"], is_correct(record)) for record in done],
+            read_stops(stops_path, take),
+        )
+
+    async def produce():
+        # 1000 test cases, read from the index as the queues take them
+        cases = get_data(data_source, continue_from, filter_case)
+        for position, x in enumerate(islice(cases, limit)):
+            # shards split the same shuffled list, every count-th case each
+            if shard is not None and position % shard.count != shard.index - 1:
+                continue
+            case = sn(**x)
+            # (case, model) pairs finished by an earlier, interrupted run are
+            # skipped, so no paid call is repeated and nothing is logged twice
+            remaining = [m for m in models if (case.key, m) not in completed]
+            if not remaining:
+                continue
+            pending[case.key] = sn(case=case, truth=None, models=remaining, records={})
+            # looked up once per case, every model gets the same candidates
+            case.values = value_index and value_index.candidates(case.question_refine)
+            case.responses = {}
+            if "cascade" in remaining:
+                loop = asyncio.get_running_loop()
+                for model in get_cascade_stages():
+                    if model in remaining:
+                        case.responses[model] = loop.create_future()
+                    elif (key := (case.key, model)) in restorable:
+                        case.responses[model] = restore_response(restorable[key])
+            progress.total += 1
+            progress.refresh()
+            # models come before the cascade, which waits for their answers
+            for model in remaining:
+                await queues[model].put(case)
+
+        for model in models:
+            for _ in range(concurrency[model]):
+                await queues[model].put(None)
+
+    async def on_result(case, model, response):
+        entry = pending[case.key]
+        if response is None:
+            # skipped by the early stop, the case is complete without it
+            entry.models.remove(model)
+        else:
+            if entry.truth is None:
+                entry.truth = asyncio.ensure_future(run_truth(case.sql))
+            truth, truth_shadow = await entry.truth
+            learn_template(case, model, response, truth)
+
+            # persisted right away, a crash only loses responses still in flight
+            record = make_record(
+                experiment_name, take, case, model, response, truth, truth_shadow
+            )
+            store.write(record)
+            records.append(record)
+            entry.records[model] = record
+            if stopper is not None and (
+                reason := stopper.update(model, case.key, is_correct(record))
+            ):
+                write_stop(stops_path, take, model, reason)
+        if len(entry.records) < len(entry.models):
+            return
+
+        del pending[case.key]
+        if text_log and entry.records:
+            print(render_case([entry.records[model] for model in entry.models]))
+
+        progress.update()
+
+    try:
+        await asyncio.gather(
+            produce(),
+            *(
+                drain_queue(
+                    model,
+                    queues[model],
+                    concurrency[model],
+                    exclude_prompts,
+                    on_result,
+                    stopper,
                 )
-                print()
-
-
-# filter_case = "9e98c86301154d7baf44b1654b51c1f0"
-batch_size = 5
-batch_limit = 200
-# exclude_prompts = {"example", "data_preview"}
-exclude_prompts = set()
-take = 2
-continue_from = None
-# continue_from = "879e430064f5011919b19ba70a193bc9"
-
-#models_filter = ["deepseek-r1"]
-models_filter = None
-
-exclude_info = "-".join(exclude_prompts) if len(exclude_prompts) else "none"
-experiment_name = f"batch_size={batch_size}&n={batch_size * batch_limit}&exclude={exclude_info}&take={take}"
-
-asyncio.run(
-    main(
-        experiment_name,
-        batch_size,
-        batch_limit,
-        exclude_prompts,
-        continue_from,
-        models_filter,
-    )
+                for model in models
+            ),
+        )
+    finally:
+        # log what interrupted cases have so far, the rest of the case gets its
+        # own block when the run is resumed
+        for entry in pending.values():
+            if entry.records and text_log:
+                print(render_case(list(entry.records.values())))
+        progress.close()
+        store.close()
+        report_plans(records)
+        report_lint(records)
+        report_engines(records)
+        report_templates(records)
+        report_cascade(records)
+        if stopper is not None:
+            report_early_stop(stopper, done + records)
+        if any(record["weight"] != 1 for record in records):
+            report_weighted(records)
+        if template_cache is not None:
+            template_cache.save()
+        report_slow_queries(read_take(results_path, take))
+
+
+def shard_path(experiment_name, shard=None):
+    if shard is None:
+        return f"output/output_{experiment_name}"
+    # kept out of output/ so that results.py only sees the merged results
+    return f"output/shards/output_{experiment_name}&shard={shard.index}of{shard.count}"
+
+
+def parse_shard(value):
+    try:
+        index, count = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, got {value}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} is not in 1..{count}")
+    return sn(index=index, count=count)
+
+
+def get_experiment_name(args):
+    exclude_info = "-".join(args.exclude) if len(args.exclude) else "none"
+    # only what changes the results; concurrency (--in_flight) is left out so
+    # that resumed runs and shards find the same files whatever it is set to
+    experiment_name = f"n={args.n}&exclude={exclude_info}&take={args.take}"
+    if args.engine != "sqlite":
+        experiment_name += f"&engine={args.engine}"
+    if value_hints:
+        experiment_name += "&values=on"
+    if args.source != "test":
+        experiment_name += f"&source={args.source}"
+    return experiment_name
+
+
+def run(args):
+    global db_engine, db_shadow_engine, data_source, filter_case, cascade
+    global template_cache_mode
+    db_engine = args.engine
+    cascade = args.cascade
+    template_cache_mode = args.template_cache
+    db_shadow_engine = args.shadow_engine
+    data_source = args.source
+    filter_case = args.filter_case
+
+    open_resources()
+    try:
+        asyncio.run(
+            main(
+                get_experiment_name(args),
+                args.in_flight,
+                args.n,
+                set(args.exclude),
+                args.continue_from,
+                args.models,
+                args.take,
+                not args.no_text_log,
+                args.shard,
+            )
+        )
+    finally:
+        close_resources()
+
+
+def merge(args):
+    experiment_name = get_experiment_name(args)
+    pattern = re.compile(r"&shard=(\d+)of(\d+)\.jsonl$")
+    shards = {}
+    prefix = glob.escape(f"output/shards/output_{experiment_name}")
+    for path in glob.glob(prefix + "&shard=*.jsonl"):
+        if match := pattern.search(path):
+            index, count = map(int, match.groups())
+            shards.setdefault(count, {})[index] = path
+    if not shards:
+        raise SystemExit(f"No shards of {experiment_name} in output/shards")
+
+    results_path = shard_path(experiment_name) + ".jsonl"
+    merged = {
+        (record["case"], record["model"]): record
+        for record in read_take(results_path, args.take)
+    }
+    store = ResultStore(results_path)
+    added = []
+    try:
+        for count, paths in sorted(shards.items()):
+            if missing := sorted(set(range(1, count + 1)) - paths.keys()):
+                tqdm.write(f"Shards of {count} missing: {missing}")
+            for index, path in sorted(paths.items()):
+                for record in read_take(path, args.take):
+                    # merging again only adds what the shards have since run,
+                    # and the retries of answers that had failed
+                    key = (record["case"], record["model"])
+                    if key in merged and (
+                        not is_failed(merged[key]) or is_failed(record)
+                    ):
+                        continue
+                    merged[key] = record
+                    store.write(record)
+                    added.append(record)
+    finally:
+        store.close()
+
+    if not args.no_text_log and added:
+        cases = {}
+        for record in added:
+            cases.setdefault(record["case"], []).append(record)
+        print = logger(shard_path(experiment_name) + ".log")
+        for records in cases.values():
+            print(render_case(records))
+    tqdm.write(f"Merged {len(added)} results into {results_path}")
+
+
+parser = argparse.ArgumentParser(description="Run the NL2SQL experiment")
+
+parser.add_argument(
+    "command",
+    nargs="?",
+    choices=["run", "merge"],
+    default="run",
+    help="Run the experiment (or one shard of it), or merge the shard results",
+)
+
+parser.add_argument(
+    "--in_flight",
+    type=int,
+    default=5,
+    help="Test cases in flight per model, unless set by meta.concurrency",
 )
+
+parser.add_argument(
+    "--n",
+    type=int,
+    default=1000,
+    help="Number of test cases to run",
+)
+
+parser.add_argument(
+    "--take",
+    type=int,
+    default=2,
+    help="Repetition of the experiment the results belong to",
+)
+
+parser.add_argument(
+    "--exclude",
+    type=str,
+    nargs="*",
+    default=[],
+    help="Prompt sections to leave out, e.g. example data_preview",
+)
+
+parser.add_argument(
+    "--models",
+    type=str,
+    nargs="*",
+    default=None,
+    help="Models to run, all of llm.models by default",
+)
+
+parser.add_argument(
+    "--source",
+    type=str,
+    default=data_source,
+    help="Test set dataset/<source>.json, e.g. a coreset written by coreset.py",
+)
+
+parser.add_argument(
+    "--continue_from",
+    type=str,
+    default=None,
+    help="Case key to start from in the shuffled order",
+)
+
+parser.add_argument(
+    "--filter_case",
+    type=str,
+    default=filter_case,
+    help="Run only the case with this key",
+)
+
+parser.add_argument(
+    "--shard",
+    type=parse_shard,
+    default=None,
+    help="Run only shard i of n (1/4 to 4/4) of the shuffled cases",
+)
+
+parser.add_argument(
+    "--no_text_log",
+    action="store_true",
+    help="Only write the JSONL results, without the human-readable log",
+)
+
+parser.add_argument(
+    "--engine",
+    type=str,
+    choices=["sqlite", "duckdb"],
+    default=db_engine,
+    help="Engine that evaluates the SQL",
+)
+
+parser.add_argument(
+    "--shadow_engine",
+    type=str,
+    choices=["sqlite", "duckdb"],
+    default=db_shadow_engine,
+    help="Also run every query on this engine to compare results and timings",
+)
+
+parser.add_argument(
+    "--cascade",
+    action="store_true",
+    default=cascade,
+    help="Also run the cheap-first cascade as one more model",
+)
+
+parser.add_argument(
+    "--template_cache",
+    type=str,
+    choices=["off", "observe", "serve"],
+    default=template_cache_mode,
+    help="Answer repeated question templates from verified SQL (rarely hits "
+    "on MIMICSQL's paraphrased questions)",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "merge":
+        merge(args)
+    else:
+        run(args)
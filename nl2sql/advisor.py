@@ -0,0 +1,181 @@
+import re
+import json
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace as sn
+
+from nl2sql.db import Budget, execute
+from nl2sql.plan import explain, classify, get_aliases
+from nl2sql.store import read_records
+
+PREDICATE_PATTERN = re.compile(
+    r"(\w+)\.\"?(\w+)\"?\s*(<=|>=|<>|!=|=|<|>|\bLIKE\b|\bIN\b|\bBETWEEN\b)"
+    r"\s*(?:(\w+)\.\"?(\w+)\"?)?",
+    re.IGNORECASE,
+)
+COLUMN_PATTERN = re.compile(r"(\w+)\.\"?(\w+)\"?")
+
+EQUALITY = {"=", "IN"}
+RANGE = {"<", ">", "<=", ">=", "BETWEEN"}
+
+
+def load_workload(paths):
+    # ground truth from the MIMICSQL JSONL, model SQL from our JSONL results
+    # or text logs
+    queries = []
+    for path in paths:
+        if path.endswith(".log"):
+            with open(path, "r") as f:
+                for line in f:
+                    if match := re.match(r"LLM \[.+?\]: (.*)", line):
+                        queries.append(match.group(1).strip())
+        elif path.endswith(".jsonl"):
+            queries += [record["sql"] for record in read_records(path)]
+        else:
+            with open(path, "r") as f:
+                queries += [json.loads(line)["sql"] for line in f if line.strip()]
+    return [q for q in queries if q and q != "--timeout--"]
+
+
+def analyse(sql, tables):
+    aliases = get_aliases(sql)
+    usage = defaultdict(lambda: sn(equality=[], range=[], join=[], columns=[]))
+
+    def resolve(name):
+        table = aliases.get(name.lower(), name.lower())
+        return table if table in tables else None
+
+    def add(items, column):
+        if column not in items:
+            items.append(column)
+
+    for name, column in COLUMN_PATTERN.findall(sql):
+        if table := resolve(name):
+            add(usage[table].columns, column.upper())
+
+    for match in PREDICATE_PATTERN.finditer(sql):
+        name, column, operator, other_name, other_column = match.groups()
+        table = resolve(name)
+        if table is None:
+            continue
+        operator = operator.upper()
+        if other_column and (other_table := resolve(other_name)):
+            add(usage[table].join, column.upper())
+            add(usage[other_table].join, other_column.upper())
+        elif operator in EQUALITY:
+            add(usage[table].equality, column.upper())
+        elif operator in RANGE:
+            add(usage[table].range, column.upper())
+
+    return usage
+
+
+def propose_indexes(
+    queries, tables, min_support=2, max_per_table=4, max_width=5, covering=True
+):
+    """Suggest composite indexes from the predicates and joins of a workload.
+
+    Every query proposes a filter index (equality columns, then one range
+    column) and a join index (join column, then equality columns) for each
+    table it touches. Candidates are ranked by the number of queries that
+    propose them; prefixes of an already chosen index are skipped. With
+    ``covering`` the chosen indexes are extended with the columns most of
+    their queries read, so those queries never touch the table rows.
+    """
+    support = Counter()
+    users = defaultdict(list)
+
+    for sql in queries:
+        for table, usage in analyse(sql, tables).items():
+            candidates = set()
+            filters = tuple(usage.equality) + tuple(usage.range[:1])
+            if filters:
+                candidates.add((table, filters))
+            for column in usage.join:
+                key = (column,) + tuple(c for c in usage.equality if c != column)
+                candidates.add((table, key))
+            for candidate in candidates:
+                support[candidate] += 1
+                users[candidate].append(usage)
+
+    chosen = defaultdict(list)
+    for (table, columns), count in support.most_common():
+        if count < min_support or len(chosen[table]) >= max_per_table:
+            continue
+        columns = columns[:max_width]
+        if any(existing[: len(columns)] == columns for existing in chosen[table]):
+            continue
+        chosen[table].append(columns)
+
+        if covering:
+            read = Counter(
+                column
+                for usage in users[(table, columns)]
+                for column in usage.columns
+                if column not in columns
+            )
+            extra = [c for c, n in read.most_common() if n * 2 >= count]
+            chosen[table][-1] = columns + tuple(extra[: max_width - len(columns)])
+
+    return [
+        sn(
+            table=table,
+            columns=columns,
+            name=f"idx_{table}_" + "_".join(c.lower() for c in columns),
+        )
+        for table, indexes in chosen.items()
+        for columns in indexes
+    ]
+
+
+def create_index(conn, index):
+    columns = ", ".join(f'"{c}"' for c in index.columns)
+    conn.execute(
+        f'CREATE INDEX IF NOT EXISTS "{index.name}" ON "{index.table}" ({columns})'
+    )
+
+
+def time_workload(conn, queries, timeout=10):
+    timings = []
+    plans = Counter()
+
+    for sql in queries:
+        try:
+            plans[classify(explain(conn, sql), sql).plan_class] += 1
+        except Exception:
+            plans["error"] += 1
+            timings.append(None)
+            continue
+
+        budget = Budget(timeout=timeout)
+        time_a = time.monotonic()
+        try:
+            with budget.watch(conn):
+                execute(conn, sql)
+            timings.append(time.monotonic() - time_a)
+        except Exception:
+            # interrupted queries count as the full timeout
+            timings.append(timeout if budget.cut_off else None)
+
+    return summarize(timings, plans)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def summarize(timings, plans=None):
+    done = [t for t in timings if t is not None]
+    return {
+        "queries": len(timings),
+        "failed": len(timings) - len(done),
+        "total": sum(done),
+        "p50": percentile(done, 50),
+        "p95": percentile(done, 95),
+        "p99": percentile(done, 99),
+        "max": max(done) if done else None,
+        "plans": dict(plans or {}),
+    }
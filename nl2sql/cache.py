@@ -0,0 +1,191 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace as sn
+
+# string literals and quoted identifiers are kept verbatim, everything between
+# them is case-folded and has its whitespace collapsed
+TOKEN_PATTERN = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+IDENTIFIER_PATTERN = re.compile(r'"\w+"')
+SPACE_PATTERN = re.compile(r"\s+")
+PUNCTUATION_PATTERN = re.compile(r"\s*([(),=<>!+*/%|-]+)\s*")
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    parts = TOKEN_PATTERN.split(sql.strip().rstrip(";").strip())
+    normalized = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            # a quoted name after "table." is always a column, so
+            # DEMOGRAPHIC."AGE" and DEMOGRAPHIC.AGE are the same statement
+            if normalized[-1].endswith(".") and IDENTIFIER_PATTERN.fullmatch(part):
+                part = part[1:-1].upper()
+            normalized.append(part)
+        else:
+            part = SPACE_PATTERN.sub(" ", part).upper()
+            normalized.append(PUNCTUATION_PATTERN.sub(r"\1", part))
+    return "".join(normalized)
+
+
+def sql_template(sql):
+    # values become ?, so every MIMICSQL question template maps to one
+    # skeleton; qualified column names are unquoted by normalize_sql first
+    return LITERAL_PATTERN.sub("?", normalize_sql(sql))
+
+
+def db_fingerprint(db_path):
+    # size, mtime and the header (file change counter, schema cookie) change
+    # whenever etl.py rewrites the DB, without hashing gigabytes of pages
+    stat = os.stat(db_path)
+    with open(db_path, "rb") as f:
+        header = f.read(100)
+    digest = hashlib.blake2b(header, digest_size=8)
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+SCHEMA_VERSION = 2
+
+
+def cache_path(db_path):
+    return db_path + ".cache"
+
+
+def invalidate(db_path):
+    for suffix in ["", "-wal", "-shm"]:
+        path = cache_path(db_path) + suffix
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ResultCache:
+    """Persistent cache of query results, keyed by normalized SQL.
+
+    Entries belong to one build of the database, so results from a DB that
+    etl.py has since rebuilt are never served. Identical statements that are
+    requested while the first one is still running wait for its result
+    instead of executing again.
+    """
+
+    def __init__(self, db_path, row_cap, step_budget=None):
+        self.db_path = db_path
+        self.row_cap = row_cap
+        self.step_budget = step_budget
+        self.db = db_fingerprint(db_path)
+
+        self.conn = sqlite3.connect(cache_path(db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS results")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (db TEXT, key TEXT, sql TEXT, "
+            "first_row TEXT, row_count INTEGER, truncated INTEGER, "
+            "fingerprint TEXT, error TEXT, elapsed REAL, steps INTEGER, "
+            "cut_off TEXT, created REAL, PRIMARY KEY (db, key))"
+        )
+        self.conn.execute("DELETE FROM results WHERE db != ?", (self.db,))
+        self.conn.commit()
+
+        self.lock = threading.Lock()
+        self.running = {}
+        self.stats = sn(hits=0, misses=0, shared=0)
+
+    def key(self, sql):
+        text = f"{self.row_cap}:{self.step_budget}:{normalize_sql(sql)}"
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def read(self, key):
+        row = self.conn.execute(
+            "SELECT first_row, row_count, truncated, fingerprint, error, elapsed, "
+            "steps, cut_off FROM results WHERE db = ? AND key = ?",
+            (self.db, key),
+        ).fetchone()
+        if row is None:
+            return None
+        first_row, row_count, truncated, fingerprint, error, elapsed, steps, cut_off = (
+            row
+        )
+        return sn(
+            first_row=None if first_row is None else tuple(json.loads(first_row)),
+            row_count=row_count,
+            truncated=bool(truncated),
+            fingerprint=fingerprint,
+            error=error,
+            elapsed=elapsed,
+            steps=steps,
+            cut_off=cut_off,
+            cached=True,
+        )
+
+    def write(self, key, sql, result):
+        first_row = result.first_row
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.db,
+                key,
+                sql,
+                None if first_row is None else json.dumps(first_row, default=str),
+                result.row_count,
+                result.truncated,
+                result.fingerprint,
+                result.error,
+                result.elapsed,
+                result.steps,
+                result.cut_off,
+                time.time(),
+            ),
+        )
+        self.conn.commit()
+
+    def run(self, sql, execute):
+        key = self.key(sql)
+        with self.lock:
+            result = self.read(key)
+            if result is not None:
+                self.stats.hits += 1
+                return result
+            future = self.running.get(key)
+            owner = future is None
+            if owner:
+                future = self.running[key] = Future()
+                self.stats.misses += 1
+            else:
+                self.stats.shared += 1
+
+        if not owner:
+            return sn(**{**vars(future.result()), "cached": True})
+
+        try:
+            result = execute()
+            # SQLite errors and step budget cut-offs are as deterministic as
+            # results, but a timeout depends on the load of this run
+            if result.cut_off != "timeout":
+                with self.lock:
+                    self.write(key, sql, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.running[key]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __str__(self):
+        return (
+            f"{cache_path(self.db_path)}: {self.stats.hits} hits, "
+            f"{self.stats.shared} shared, {self.stats.misses} executed"
+        )
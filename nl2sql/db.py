@@ -0,0 +1,257 @@
+import os
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace as sn
+from urllib.request import pathname2url
+
+MMAP_SIZE = 2**32  # 4 GiB, enough to map all of database_full.db
+CACHE_SIZE = -(2**19)  # negative values are KiB, so 512 MiB per connection
+REPLICAS = {None, "shared", "private"}
+ROW_CAP = 100000
+FETCH_SIZE = 1000
+STEP_INTERVAL = 1000  # VM instructions between progress handler calls
+
+
+class ConnectionPool:
+    """Read-only SQLite connections shared by all evaluation queries.
+
+    With ``replica="shared"`` the database is copied once into a shared-cache
+    in-memory database that every pooled connection attaches to. With
+    ``replica="private"`` every connection gets its own ``:memory:`` copy,
+    which costs ``size`` times the RAM but avoids the shared-cache mutex.
+    """
+
+    def __init__(
+        self,
+        db_path,
+        size=4,
+        mmap_size=MMAP_SIZE,
+        cache_size=CACHE_SIZE,
+        immutable=True,
+        replica=None,
+    ):
+        if replica not in REPLICAS:
+            raise ValueError(f"Unknown replica mode: {replica}")
+
+        self.db_path = db_path
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.immutable = immutable
+        self.replica = replica
+        self.anchor = None
+
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.closed = False
+        self.stats = sn(opened=0, reused=0, replica_load_time=0.0, replica_bytes=0)
+
+    def uri(self):
+        uri = "file:" + pathname2url(os.path.abspath(self.db_path)) + "?mode=ro"
+        if self.immutable:
+            # the evaluation DB is only rebuilt offline by etl.py, so SQLite
+            # can skip file locking and change detection entirely
+            uri += "&immutable=1"
+        return uri
+
+    def replica_uri(self):
+        return f"file:nl2sql_replica_{id(self)}?mode=memory&cache=shared"
+
+    def load_replica(self, uri=":memory:"):
+        time_a = time.monotonic()
+
+        source = sqlite3.connect(self.uri(), uri=True)
+        target = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+
+        page_count = target.execute("PRAGMA page_count").fetchone()[0]
+        page_size = target.execute("PRAGMA page_size").fetchone()[0]
+
+        self.stats.replica_load_time += time.monotonic() - time_a
+        self.stats.replica_bytes += page_count * page_size
+        return target
+
+    def connect(self):
+        if self.replica == "private":
+            conn = self.load_replica()
+        elif self.replica == "shared":
+            if self.anchor is None:
+                # the anchor keeps the shared in-memory database alive for as
+                # long as the pool is open
+                self.anchor = self.load_replica(self.replica_uri())
+            conn = sqlite3.connect(
+                self.replica_uri(), uri=True, check_same_thread=False
+            )
+        else:
+            conn = sqlite3.connect(self.uri(), uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute("PRAGMA query_only = ON")
+        # parse the schema up front instead of on the first evaluation query
+        conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        return conn
+
+    def warm(self):
+        with self.lock:
+            while len(self.connections) < self.size:
+                conn = self.connect()
+                self.connections.append(conn)
+                self.idle.put(conn)
+                self.stats.opened += 1
+
+    def acquire(self):
+        if self.closed:
+            raise RuntimeError("Connection pool is closed")
+
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is None:
+            with self.lock:
+                if len(self.connections) < self.size:
+                    conn = self.connect()
+                    self.connections.append(conn)
+                    self.stats.opened += 1
+                    return conn
+            conn = self.idle.get()
+
+        with self.lock:
+            self.stats.reused += 1
+        return conn
+
+    def release(self, conn):
+        if self.closed:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+            if self.anchor is not None:
+                self.anchor.close()
+                self.anchor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __str__(self):
+        description = (
+            f"{self.db_path}: {self.stats.opened} connections opened, "
+            f"{self.stats.reused} reused"
+        )
+        if self.replica:
+            description += (
+                f", {self.replica} in-memory replica of "
+                f"{self.stats.replica_bytes / 2**20:.1f} MiB "
+                f"loaded in {self.stats.replica_load_time:.2f}s"
+            )
+        return description
+
+
+class Budget:
+    """Execution budget in SQLite VM steps, with an optional wall-clock limit.
+
+    The progress handler runs on the executing thread every ``interval`` VM
+    instructions, so the step count does not depend on machine load and no
+    timer thread is needed. A statement over budget fails with
+    ``sqlite3.OperationalError: interrupted`` and ``cut_off`` says why.
+    """
+
+    def __init__(self, steps=None, timeout=None, interval=STEP_INTERVAL):
+        self.max_steps = steps
+        self.timeout = timeout
+        self.interval = interval
+        self.steps = 0
+        self.cut_off = None
+        self.deadline = None
+
+    def progress(self):
+        self.steps += self.interval
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self.cut_off = "steps"
+        elif self.deadline is not None and time.monotonic() > self.deadline:
+            self.cut_off = "timeout"
+        return self.cut_off is not None
+
+    @contextmanager
+    def watch(self, conn):
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        conn.set_progress_handler(self.progress, self.interval)
+        try:
+            yield self
+        finally:
+            # removed before the connection goes back to the pool
+            conn.set_progress_handler(None, 0)
+
+
+class ResultFingerprint:
+    """Order-insensitive digest of a result set, built one batch at a time.
+
+    Every row is hashed on its own and the hashes are summed, so two results
+    match when they hold the same rows the same number of times, in any order.
+    """
+
+    def __init__(self):
+        self.digest = 0
+        self.row_count = 0
+        self.first_row = None
+        self.truncated = False
+
+    def update(self, rows):
+        for row in rows:
+            if self.row_count == 0:
+                self.first_row = row
+            row_hash = hashlib.blake2b(repr(row).encode(), digest_size=8).digest()
+            self.digest = (self.digest + int.from_bytes(row_hash, "big")) % 2**64
+            self.row_count += 1
+
+    def hexdigest(self):
+        return f"{self.digest:016x}:{self.row_count}"
+
+
+def execute(conn, sql, row_cap=ROW_CAP, batch_size=FETCH_SIZE):
+    # rows are streamed into the fingerprint and never kept, so a runaway
+    # join costs at most row_cap rows of work and no memory
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        result = ResultFingerprint()
+        while rows := cursor.fetchmany(batch_size):
+            room = row_cap - result.row_count
+            result.update(rows[:room])
+            if len(rows) > room:
+                result.truncated = True
+                break
+            if result.row_count >= row_cap:
+                result.truncated = cursor.fetchone() is not None
+                break
+        return result
+    finally:
+        cursor.close()
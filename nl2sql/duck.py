@@ -0,0 +1,133 @@
+import re
+import threading
+import time
+from types import SimpleNamespace as sn
+
+from nl2sql.db import ResultFingerprint, ROW_CAP, FETCH_SIZE
+from nl2sql.lint import tokenize
+
+# SQLite date functions without a DuckDB function of the same signature
+UNSUPPORTED_FUNCTIONS = {"STRFTIME", "JULIANDAY", "DATETIME", "DATE", "TIME"}
+
+
+def connect(path, read_only=True):
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("The DuckDB backend needs duckdb, pip install duckdb")
+    return duckdb.connect(path, read_only=read_only)
+
+
+def translate(sql, columns):
+    """Rewrite SQLite SQL for DuckDB and list the dialect differences found.
+
+    Handled: double-quoted values (SQLite falls back to a string when no
+    column has that name, DuckDB does not) and LIKE, which is only case
+    insensitive in SQLite. Integer division is handled by the connection
+    setting. SQLite date functions are reported, not rewritten.
+    """
+    tokens = tokenize(sql)
+    notes = []
+    parts = []
+
+    for i, token in enumerate(tokens):
+        value = token.value
+        if token.kind == "quoted" and value[1:-1].upper() not in columns:
+            value = "'" + value[1:-1].replace('""', '"').replace("'", "''") + "'"
+            note = "double-quoted string"
+        elif token.kind == "keyword" and value == "LIKE":
+            value = "ILIKE"
+            note = "case-insensitive LIKE"
+        elif (
+            token.kind == "name"
+            and value.upper() in UNSUPPORTED_FUNCTIONS
+            and i + 1 < len(tokens)
+            and tokens[i + 1].value == "("
+        ):
+            note = f"unsupported function {value.upper()}"
+        else:
+            note = None
+
+        if note and note not in notes:
+            notes.append(note)
+        parts.append(value)
+
+    return " ".join(parts), notes
+
+
+class DuckBackend:
+    """Read-only DuckDB copy of the evaluation DB, built by etl.py.
+
+    DuckDB connections are not shared between threads, so every executor
+    thread gets its own cursor on the one database instance.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = connect(path)
+        self.conn.execute("SET integer_division = true")
+        self.columns = {
+            column.upper()
+            for (column,) in self.conn.execute(
+                "SELECT column_name FROM information_schema.columns"
+            ).fetchall()
+        }
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def cursor(self):
+        if not hasattr(self.local, "cursor"):
+            with self.lock:
+                self.local.cursor = self.conn.cursor()
+                self.local.cursor.execute("SET integer_division = true")
+        return self.local.cursor
+
+    def query(self, sql, timeout=10, row_cap=ROW_CAP, batch_size=FETCH_SIZE):
+        result = sn(
+            first_row=None,
+            row_count=None,
+            truncated=False,
+            fingerprint=None,
+            error=None,
+            elapsed=None,
+            cached=False,
+            steps=None,
+            cut_off=None,
+            dialect=None,
+        )
+        translated, result.dialect = translate(sql, self.columns)
+        cursor = self.cursor()
+
+        def interrupt():
+            result.cut_off = "timeout"
+            cursor.interrupt()
+
+        timer = threading.Timer(timeout, interrupt)
+        time_a = time.monotonic()
+        try:
+            timer.start()
+            cursor.execute(translated)
+            fingerprint = ResultFingerprint()
+            while rows := cursor.fetchmany(batch_size):
+                room = row_cap - fingerprint.row_count
+                fingerprint.update(rows[:room])
+                if len(rows) > room:
+                    fingerprint.truncated = True
+                    break
+                if fingerprint.row_count >= row_cap:
+                    fingerprint.truncated = cursor.fetchone() is not None
+                    break
+            result.first_row = fingerprint.first_row
+            result.row_count = fingerprint.row_count
+            result.truncated = fingerprint.truncated
+            result.fingerprint = fingerprint.hexdigest()
+        except Exception as e:
+            result.error = re.sub(r"\s+", " ", str(e)).strip()
+        finally:
+            timer.cancel()
+
+        result.elapsed = time.monotonic() - time_a
+        return result
+
+    def close(self):
+        self.conn.close()
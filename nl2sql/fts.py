@@ -0,0 +1,168 @@
+import re
+
+from nl2sql.lint import tokenize, collect_tables
+
+VIRTUAL_PATTERN = re.compile(
+    r"USING\s+fts5\s*\(\s*\"?(\w+)\"?.*content\s*=\s*'(\w+)'", re.IGNORECASE
+)
+# three characters in a row between wildcards, the shortest substring the
+# trigram index can look up instead of scanning
+TRIGRAM_PATTERN = re.compile(r"[^%_]{3}")
+PRECEDING = {"WHERE", "AND", "OR", "ON", "HAVING"}
+FOLLOWING = {
+    "AND",
+    "OR",
+    ")",
+    ";",
+    "GROUP",
+    "ORDER",
+    "LIMIT",
+    "HAVING",
+    "UNION",
+    "EXCEPT",
+    "INTERSECT",
+    "WINDOW",
+}
+
+
+def fts_name(table, column):
+    return f"fts_{table}_{column.lower()}"
+
+
+def create_fts(conn, table, column):
+    """Build a trigram FTS5 index over one text column of a table.
+
+    The index stores no text of its own (external content), only trigrams
+    pointing at the rowids of ``table``. Trigram FTS5 answers LIKE and GLOB
+    with the same case-insensitive semantics as SQLite's LIKE for ASCII.
+    """
+    name = fts_name(table, column)
+    conn.execute(f'DROP TABLE IF EXISTS "{name}"')
+    conn.execute(
+        f'CREATE VIRTUAL TABLE "{name}" USING fts5("{column}", '
+        f"content='{table}', content_rowid='rowid', tokenize='trigram')"
+    )
+    conn.execute(f'INSERT INTO "{name}" ("{name}") VALUES (\'rebuild\')')
+    return name
+
+
+def find_fts(conn):
+    indexes = {}
+    for name, sql in conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE sql LIKE 'CREATE VIRTUAL TABLE%'"
+    ):
+        if match := VIRTUAL_PATTERN.search(sql):
+            column, table = match.groups()
+            indexes[(table.lower(), column.upper())] = name
+    return indexes
+
+
+def rebuild_fts(conn, table=None):
+    # rowids of tables without an INTEGER PRIMARY KEY change when the table
+    # is rewritten or vacuumed, so the index has to follow
+    for (content, _), name in find_fts(conn).items():
+        if table is None or content == table.lower():
+            conn.execute(f'INSERT INTO "{name}" ("{name}") VALUES (\'rebuild\')')
+
+
+def rewrite(sql, indexes, schema):
+    """Serve substring LIKE predicates from trigram FTS5 indexes.
+
+    ``t.COL LIKE '%text%'`` and ``LOWER(t.COL) LIKE '%text%'`` become
+    ``t.rowid IN (SELECT rowid FROM fts_t_col WHERE COL LIKE '%text%')``
+    when COL has an index. The two only differ for NULL values, which is
+    harmless in a WHERE clause, so only predicates that are plain terms of
+    WHERE, ON or HAVING are rewritten, and nothing under NOT (...) or in a
+    statement with a CTE, a derived table or a table function. Returns the
+    SQL unchanged when nothing applies.
+    """
+    if not indexes or "LIKE" not in sql.upper():
+        return sql
+
+    tokens = tokenize(sql)
+    if any(
+        token.value == "NOT" and tokens[i + 1].value == "("
+        for i, token in enumerate(tokens[:-1])
+    ):
+        return sql
+    aliases, _, _ = collect_tables(tokens, schema)
+    # CTEs, subqueries and table functions in FROM hide which table a column
+    # and its rowid come from, so such statements are left alone
+    if None in aliases.values() or any(
+        token.value == "(" and tokens[i + 1].value == "SELECT"
+        for i, token in enumerate(tokens[:-1])
+        if i > 0 and tokens[i - 1].value in ("FROM", "JOIN", ",")
+    ):
+        return sql
+    # an unqualified column is only resolved when there is a single table
+    single = set(aliases.values())
+    single = next(iter(single)) if len(single) == 1 else None
+    columns = set().union(*schema.values())
+
+    def match(i):
+        # (qualifier, column, index, pattern, position after the predicate)
+        before = i - 1
+        while before >= 0 and tokens[before].value == "(":
+            before -= 1
+        if before < 0 or tokens[before].value not in PRECEDING:
+            return None
+        lowered = tokens[i].kind == "name" and tokens[i].value.upper() == "LOWER"
+        if lowered:
+            if i + 1 >= len(tokens) or tokens[i + 1].value != "(":
+                return None
+            i += 2
+        if i + 2 < len(tokens) and tokens[i + 1].value == ".":
+            qualifier, column, table, i = (
+                tokens[i].value,
+                tokens[i + 2].value,
+                aliases.get(tokens[i].value.lower()),
+                i + 3,
+            )
+        elif i < len(tokens) and tokens[i].kind == "name":
+            qualifier, column, table, i = None, tokens[i].value, single, i + 1
+        else:
+            return None
+        if lowered:
+            if i >= len(tokens) or tokens[i].value != ")":
+                return None
+            i += 1
+        if (
+            i + 1 >= len(tokens)
+            or tokens[i].value != "LIKE"
+            or tokens[i + 1].kind not in ("string", "quoted")
+            or (i + 2 < len(tokens) and tokens[i + 2].value not in FOLLOWING)
+        ):
+            return None
+        pattern = tokens[i + 1].value
+        if tokens[i + 1].kind == "quoted":
+            # a double-quoted pattern is a string unless a column has its name
+            if pattern[1:-1].upper() in columns:
+                return None
+            pattern = "'" + pattern[1:-1].replace('""', '"').replace("'", "''") + "'"
+        name = indexes.get((table, column.upper()))
+        if (
+            name is None
+            or not pattern.startswith("'%")
+            or not TRIGRAM_PATTERN.search(pattern[1:-1])
+        ):
+            return None
+        return qualifier, column, name, pattern, i + 2
+
+    parts = [token.value for token in tokens]
+    i = 0
+    while i < len(tokens):
+        found = match(i)
+        if found is None:
+            i += 1
+            continue
+        qualifier, column, name, pattern, end = found
+        rowid = f"{qualifier}.rowid" if qualifier else "rowid"
+        parts[i] = (
+            f'{rowid} IN (SELECT rowid FROM "{name}" '
+            f'WHERE "{column.upper()}" LIKE {pattern})'
+        )
+        for j in range(i + 1, end):
+            parts[j] = None
+        i = end
+
+    return " ".join(part for part in parts if part is not None)
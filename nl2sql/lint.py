@@ -0,0 +1,266 @@
+import re
+from types import SimpleNamespace as sn
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<string>'(?:[^']|'')*')
+    |(?P<quoted>"(?:[^"]|"")*")
+    |(?P<bracketed>`[^`]*`|\[[^\]]*\])
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+    |(?P<name>[A-Za-z_][\w$]*)
+    |(?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<space>\s+)
+    |(?P<punct>\|\||<=|>=|<>|!=|==|<<|>>|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# https://www.sqlite.org/lang_keywords.html
+KEYWORDS = set("""
+    ABORT ACTION ADD AFTER ALL ALTER ALWAYS ANALYZE AND AS ASC ATTACH
+    AUTOINCREMENT BEFORE BEGIN BETWEEN BY CASCADE CASE CAST CHECK COLLATE
+    COLUMN COMMIT CONFLICT CONSTRAINT CREATE CROSS CURRENT CURRENT_DATE
+    CURRENT_TIME CURRENT_TIMESTAMP DATABASE DEFAULT DEFERRABLE DEFERRED DELETE
+    DESC DETACH DISTINCT DO DROP EACH ELSE END ESCAPE EXCEPT EXCLUDE EXCLUSIVE
+    EXISTS EXPLAIN FAIL FILTER FIRST FOLLOWING FOR FOREIGN FROM FULL GENERATED
+    GLOB GROUP GROUPS HAVING IF IGNORE IMMEDIATE IN INDEX INDEXED INITIALLY
+    INNER INSERT INSTEAD INTERSECT INTO IS ISNULL JOIN KEY LAST LEFT LIKE LIMIT
+    MATCH MATERIALIZED NATURAL NO NOT NOTHING NOTNULL NULL NULLS OF OFFSET ON
+    OR ORDER OTHERS OUTER OVER PARTITION PLAN PRAGMA PRECEDING PRIMARY QUERY
+    RAISE RANGE RECURSIVE REFERENCES REGEXP REINDEX RELEASE RENAME REPLACE
+    RESTRICT RETURNING RIGHT ROLLBACK ROW ROWS SAVEPOINT SELECT SET TABLE TEMP
+    TEMPORARY THEN TIES TO TRANSACTION TRIGGER UNBOUNDED UNION UNIQUE UPDATE
+    USING VACUUM VALUES VIEW VIRTUAL WHEN WHERE WINDOW WITH WITHOUT TRUE FALSE
+    """.split())
+TABLE_KEYWORDS = {"FROM", "JOIN"}
+END_OF_TABLES = {
+    "WHERE",
+    "GROUP",
+    "ORDER",
+    "LIMIT",
+    "HAVING",
+    "UNION",
+    "EXCEPT",
+    "INTERSECT",
+    "ON",
+    "USING",
+    "WINDOW",
+    "SELECT",
+    "VALUES",
+}
+ROWID_NAMES = {"ROWID", "OID", "_ROWID_"}
+
+
+def load_schema(conn):
+    schema = {}
+    tables = conn.execute(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    # FTS5 indexes and their shadow tables are not part of the data model
+    virtual = [name for name, sql in tables if sql.startswith("CREATE VIRTUAL")]
+    for table, _ in tables:
+        if any(table == v or table.startswith(v + "_") for v in virtual):
+            continue
+        columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        schema[table.lower()] = {column[1].upper() for column in columns}
+    return schema
+
+
+def tokenize(sql):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        kind, value = match.lastgroup, match.group()
+        if kind in ("space", "comment"):
+            continue
+        if kind == "bracketed":
+            kind, value = "name", value[1:-1]
+        elif kind == "name" and value.upper() in KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append(sn(kind=kind, value=value))
+
+    # "x" is an identifier next to a dot; elsewhere SQLite falls back to a
+    # string when no column matches, which MIMICSQL relies on for values
+    for i, token in enumerate(tokens):
+        if token.kind == "quoted" and (
+            (i > 0 and tokens[i - 1].value == ".")
+            or (i + 1 < len(tokens) and tokens[i + 1].value == ".")
+        ):
+            token.kind, token.value = "name", token.value[1:-1].replace('""', '"')
+    return tokens
+
+
+def is_name(tokens, i):
+    return 0 <= i < len(tokens) and tokens[i].kind == "name"
+
+
+def as_name(token):
+    # a double-quoted token where only a table or alias can stand
+    if token.kind == "quoted":
+        token.kind, token.value = "name", token.value[1:-1].replace('""', '"')
+    return token
+
+
+def collect_tables(tokens, schema):
+    """Find the tables, aliases and CTEs of a statement.
+
+    Returns a map from every name a table can be referenced by to its
+    schema table, or None for CTEs, subqueries and table functions whose
+    columns are unknown, plus the positions of the names it consumed.
+    """
+    aliases = {}
+    errors = []
+    consumed = set()
+
+    expecting = False
+    in_tables = [False]  # per parenthesis depth
+    derived = []  # per parenthesis depth, whether it is a subquery in FROM
+    in_with = False
+
+    def read_alias(i):
+        # returns the alias following position i, and the last position read
+        j = i + 1
+        if j < len(tokens) and tokens[j].value == "AS":
+            j += 1
+        if j < len(tokens):
+            as_name(tokens[j])
+        if is_name(tokens, j):
+            consumed.add(j)
+            return tokens[j].value.lower(), j
+        return None, i
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+
+        if token.value == "WITH":
+            in_with = True
+        elif in_with and len(in_tables) == 1 and token.kind == "name":
+            aliases[token.value.lower()] = None
+            consumed.add(i)
+        elif token.value in TABLE_KEYWORDS:
+            expecting = True
+            in_tables[-1] = True
+            in_with = False
+        elif token.value in END_OF_TABLES:
+            expecting = False
+            in_tables[-1] = False
+            if token.value == "SELECT" and len(in_tables) == 1:
+                in_with = False
+        elif token.value == "(":
+            derived.append(expecting)
+            in_tables.append(False)
+            expecting = False
+        elif token.value == ")":
+            if len(in_tables) > 1:
+                in_tables.pop()
+            if derived and derived.pop():
+                alias, i = read_alias(i)
+                if alias:
+                    aliases[alias] = None
+        elif token.value == "," and in_tables[-1]:
+            expecting = True
+        elif expecting and token.kind in ("name", "quoted"):
+            as_name(token)
+            expecting = False
+            consumed.add(i)
+            if i + 2 < len(tokens) and tokens[i + 1].value == ".":
+                # schema qualified, main.lab
+                i += 2
+                consumed.add(i)
+            name = tokens[i].value.lower()
+            if i + 1 < len(tokens) and tokens[i + 1].value == "(":
+                # table-valued function such as json_each(...)
+                aliases[name] = None
+                i += 1
+                continue
+            if name in schema:
+                table = name
+            elif name in aliases:
+                table = aliases[name]
+            else:
+                table = None
+                errors.append(f"no such table: {tokens[i].value}")
+            aliases[name] = table
+            alias, i = read_alias(i)
+            if alias:
+                aliases[alias] = table
+        i += 1
+
+    return aliases, errors, consumed
+
+
+def lint(sql, schema):
+    """Check table and column names of a statement against the schema.
+
+    Only names that are certainly wrong are reported, with the message
+    SQLite would give. Unqualified columns are only checked when every table
+    in the statement comes from the schema, and unqualified double-quoted
+    names are skipped because SQLite reads them as strings when no column
+    matches.
+    """
+    tokens = tokenize(sql)
+    aliases, errors, consumed = collect_tables(tokens, schema)
+
+    tables = {table for table in aliases.values() if table is not None}
+    in_scope = set().union(*(schema[table] for table in tables))
+    check_unqualified = tables and None not in aliases.values()
+
+    column_aliases = {
+        tokens[i + 1].value.upper()
+        for i, token in enumerate(tokens[:-1])
+        if token.value == "AS" and tokens[i + 1].kind in ("name", "quoted")
+    }
+
+    def owners(column):
+        return sorted(t for t, columns in schema.items() if column in columns)
+
+    def missing(name, column):
+        message = f"no such column: {name}"
+        if tables_with := owners(column):
+            message += f" (column of {', '.join(tables_with)})"
+        errors.append(message)
+
+    skip = set(consumed)
+    for i, token in enumerate(tokens):
+        if i in skip or token.kind != "name":
+            continue
+        if i + 1 < len(tokens) and tokens[i + 1].value == "(":
+            continue
+
+        if i + 2 < len(tokens) and tokens[i + 1].value == ".":
+            skip.add(i + 2)
+            qualifier = token.value.lower()
+            column = tokens[i + 2]
+            if column.value == "*":
+                if qualifier not in aliases:
+                    errors.append(f"no such table: {token.value}")
+                continue
+            if qualifier not in aliases:
+                missing(f"{token.value}.{column.value}", column.value.upper())
+            elif aliases[qualifier] is not None:
+                columns = schema[aliases[qualifier]]
+                name = column.value.upper()
+                if name not in columns and name not in ROWID_NAMES:
+                    missing(f"{token.value}.{column.value}", name)
+            continue
+
+        name = token.value.upper()
+        previous = tokens[i - 1] if i > 0 else None
+        if previous is not None and (
+            previous.value in ("AS", "END", ")")
+            or previous.kind in ("name", "string", "quoted", "number")
+        ):
+            # an alias, as in COUNT(*) cnt or CASE ... END label
+            continue
+        if (
+            not check_unqualified
+            or name in in_scope
+            or name in column_aliases
+            or name in ROWID_NAMES
+            or token.value.lower() in aliases
+        ):
+            continue
+        missing(token.value, name)
+
+    return sn(ok=not errors, errors=errors)
@@ -0,0 +1,137 @@
+import os
+import json
+import random
+import sqlite3
+import tempfile
+from array import array
+
+SEED = 42
+
+
+class CaseIndex:
+    """Shuffled, seekable view over a JSONL test set.
+
+    The shuffle permutation and the byte offset of every line are built once
+    and persisted next to the data file, so cases are read lazily and resuming
+    from a key or position is a single index lookup.
+    """
+
+    def __init__(self, path, seed=SEED):
+        self.path = path
+        self.index_path = path + ".index"
+        self.seed = seed
+
+        self.conn = self.open()
+        if not self.is_current():
+            self.conn.close()
+            self.build()
+            self.conn = self.open()
+
+    def open(self):
+        return sqlite3.connect(self.index_path)
+
+    def signature(self):
+        stat = os.stat(self.path)
+        return {
+            "size": str(stat.st_size),
+            "mtime": str(stat.st_mtime_ns),
+            "seed": str(self.seed),
+        }
+
+    def is_current(self):
+        try:
+            meta = dict(self.conn.execute("SELECT name, value FROM meta"))
+        except sqlite3.OperationalError:
+            return False
+        return meta == self.signature()
+
+    def build(self):
+        # shards of a run may all build the index at once, so each builds
+        # its own file and the last complete one replaces the index
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(self.index_path) + ".",
+            suffix=".tmp",
+            dir=os.path.dirname(self.index_path) or ".",
+        )
+        os.close(fd)
+
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+        conn.execute(
+            "CREATE TABLE lines (line INTEGER PRIMARY KEY, offset INTEGER, key TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE cases (position INTEGER PRIMARY KEY, line INTEGER, "
+            "offset INTEGER, key TEXT)"
+        )
+
+        def scan():
+            with open(self.path, "rb") as f:
+                offset = 0
+                line = 0
+                for raw in iter(f.readline, b""):
+                    if raw.strip():
+                        yield line, offset, json.loads(raw).get("key")
+                        line += 1
+                    offset += len(raw)
+
+        conn.executemany("INSERT INTO lines VALUES (?, ?, ?)", scan())
+        count = conn.execute("SELECT count(*) FROM lines").fetchone()[0]
+
+        # same order as the original reversed + random.shuffle loader, kept
+        # in a compact array so this scales past MIMICSQL's 1000 rows
+        permutation = array("q", range(count - 1, -1, -1))
+        random.Random(self.seed).shuffle(permutation)
+
+        conn.executemany(
+            "INSERT INTO cases (position, line) VALUES (?, ?)",
+            enumerate(permutation),
+        )
+        conn.execute(
+            "UPDATE cases SET (offset, key) = "
+            "(SELECT offset, key FROM lines WHERE lines.line = cases.line)"
+        )
+        conn.execute("DROP TABLE lines")
+        conn.execute("CREATE INDEX idx_cases_key ON cases (key)")
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", self.signature().items())
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+
+        os.replace(tmp_path, self.index_path)
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM cases").fetchone()[0]
+
+    def position(self, key):
+        row = self.conn.execute(
+            "SELECT position FROM cases WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"Case {key} is not in {self.path}")
+        return row[0]
+
+    def get(self, key):
+        return self.read(self.position(key))
+
+    def read(self, position):
+        row = self.conn.execute(
+            "SELECT offset FROM cases WHERE position = ?", (position,)
+        ).fetchone()
+        if row is None:
+            raise IndexError(position)
+        with open(self.path, "rb") as f:
+            f.seek(row[0])
+            return json.loads(f.readline())
+
+    def iter(self, start=0):
+        cursor = self.conn.execute(
+            "SELECT offset FROM cases WHERE position >= ? ORDER BY position", (start,)
+        )
+        with open(self.path, "rb") as f:
+            for (offset,) in cursor:
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,78 @@
+import re
+from types import SimpleNamespace as sn
+
+# tables of database_full.db with hundreds of thousands to millions of rows;
+# demographic is small enough to scan on every query
+LARGE_TABLES = {"lab", "prescriptions", "diagnoses", "procedures"}
+
+# ordered from harmless to pathological
+PLAN_CLASSES = ["ok", "scan", "unindexed_join"]
+
+LOOP_PATTERN = re.compile(r"^(SCAN|SEARCH) (\S+)(?: AS (\S+))?(.*)$")
+ALIAS_PATTERN = re.compile(
+    r"(?:\bFROM|\bJOIN|,)\s*\"?(\w+)\"?(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|INNER\b|LEFT\b"
+    r"|JOIN\b|GROUP\b|ORDER\b|LIMIT\b|NATURAL\b|CROSS\b|FROM\b)(\w+))?",
+    re.IGNORECASE,
+)
+
+
+def explain(conn, sql):
+    return [
+        (node_id, parent, detail)
+        for node_id, parent, _, detail in conn.execute("EXPLAIN QUERY PLAN " + sql)
+    ]
+
+
+def get_aliases(sql):
+    aliases = {}
+    for table, alias in ALIAS_PATTERN.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def classify(plan, sql, large_tables=LARGE_TABLES):
+    aliases = get_aliases(sql)
+    plan_class = "ok"
+    reasons = []
+    loops = {}
+
+    def flag(level, reason):
+        nonlocal plan_class
+        reasons.append(reason)
+        if PLAN_CLASSES.index(level) > PLAN_CLASSES.index(plan_class):
+            plan_class = level
+
+    for _, parent, detail in plan:
+        match = LOOP_PATTERN.match(detail)
+        if not match:
+            continue
+
+        operation, name, alias, rest = match.groups()
+        table = aliases.get((alias or name).lower(), name.lower())
+        # loops that share a parent are nested in the order they are listed
+        nested = loops.get(parent, 0) > 0
+        loops[parent] = loops.get(parent, 0) + 1
+
+        if table not in large_tables:
+            continue
+
+        if "AUTOMATIC" in rest:
+            flag("unindexed_join", f"no index to join {table}")
+        elif operation == "SCAN" and nested:
+            flag("unindexed_join", f"nested scan of {table}")
+        elif operation == "SCAN":
+            flag("scan", f"full scan of {table}")
+
+    return sn(
+        plan_class=plan_class,
+        reasons=reasons,
+        detail=[detail for _, _, detail in plan],
+    )
+
+
+def is_rejected(plan_class, reject_from):
+    if reject_from is None:
+        return False
+    return PLAN_CLASSES.index(plan_class) >= PLAN_CLASSES.index(reject_from)
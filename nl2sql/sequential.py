@@ -0,0 +1,132 @@
+from math import sqrt
+from statistics import NormalDist
+from types import SimpleNamespace as sn
+
+
+def z_value(confidence, looks=1):
+    # two-sided, Bonferroni corrected for every look taken at the data, so
+    # stopping at the first look that is precise enough keeps its coverage
+    return NormalDist().inv_cdf(1 - (1 - confidence) / (2 * looks))
+
+
+def wilson(correct, n, z):
+    if not n:
+        return 0.0, 1.0
+    p = correct / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    half = z * sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def paired_difference(a, b, z):
+    # accuracy of a minus b over the cases both have answered, as the adjusted
+    # Wald interval of Bonett and Price (2012); unlike the plain paired one it
+    # does not collapse to [0, 0] while the two agree on every case
+    shared = a.keys() & b.keys()
+    n = len(shared)
+    if n < 2:
+        return None
+    only_a = (sum(a[case] > b[case] for case in shared) + 1) / (n + 2)
+    only_b = (sum(b[case] > a[case] for case in shared) + 1) / (n + 2)
+    difference = only_a - only_b
+    half = z * sqrt((only_a + only_b - difference**2) / (n + 2))
+    return difference - half, difference + half
+
+
+class SequentialStop:
+    """Stops evaluating a model once its accuracy is known well enough.
+
+    Every ``step`` answered cases a model's accuracy gets a confidence
+    interval. It stops when the interval is narrower than ±``precision``, or
+    when the paired difference to every other model is decided at
+    ``margin``: both models are either within ±``margin`` of each other or
+    one is clearly better.
+    """
+
+    def __init__(
+        self,
+        models,
+        total,
+        precision=None,
+        margin=None,
+        confidence=0.95,
+        step=25,
+        min_cases=50,
+    ):
+        self.models = models
+        self.precision = precision
+        self.margin = margin
+        self.step = step
+        self.min_cases = min_cases
+        self.z = z_value(confidence, looks=max(1, total // step))
+        self.outcomes = {model: {} for model in models}
+        self.reasons = {}
+        self.skipped = {model: 0 for model in models}
+
+    def restore(self, outcomes, reasons):
+        # (model, case, correct) answered by an earlier run of the same take,
+        # and the models it stopped
+        for model, case, correct in outcomes:
+            if model in self.outcomes:
+                self.outcomes[model][case] = int(correct)
+        self.reasons.update(
+            (model, reason)
+            for model, reason in reasons.items()
+            if model in self.outcomes
+        )
+
+    def stopped(self, model):
+        return model in self.reasons
+
+    def skip(self, model):
+        self.skipped[model] += 1
+
+    def update(self, model, case, correct):
+        outcomes = self.outcomes[model]
+        outcomes[case] = int(correct)
+        n = len(outcomes)
+        if model in self.reasons or n < self.min_cases or n % self.step:
+            return None
+        if reason := self.check(model):
+            self.reasons[model] = reason
+        return reason
+
+    def check(self, model):
+        outcomes = self.outcomes[model]
+        if self.precision is not None:
+            low, high = wilson(sum(outcomes.values()), len(outcomes), self.z)
+            if (high - low) / 2 <= self.precision:
+                return f"±{self.precision:.3f} reached"
+
+        if self.margin is not None and len(self.models) > 1:
+            decisions = []
+            for other in self.models:
+                if other == model:
+                    continue
+                interval = paired_difference(outcomes, self.outcomes[other], self.z)
+                if interval is None:
+                    return None
+                low, high = interval
+                if -self.margin < low and high < self.margin:
+                    decisions.append(f"≈ {other}")
+                elif low > 0:
+                    decisions.append(f"> {other}")
+                elif high < 0:
+                    decisions.append(f"< {other}")
+                else:
+                    return None
+            return ", ".join(decisions)
+        return None
+
+    def summary(self, model):
+        outcomes = self.outcomes[model]
+        correct = sum(outcomes.values())
+        low, high = wilson(correct, len(outcomes), self.z)
+        return sn(
+            n=len(outcomes),
+            correct=correct,
+            low=low,
+            high=high,
+            reason=self.reasons.get(model),
+            skipped=self.skipped[model],
+        )
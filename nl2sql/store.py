@@ -0,0 +1,175 @@
+import os
+import json
+import queue
+import sys
+import threading
+import time
+
+
+class ResultStore:
+    """Append-only JSONL store with one record per (case, model, take).
+
+    Records are handed to a background thread which writes them in batches,
+    so the event loop never waits on the disk.
+    """
+
+    def __init__(self, path, buffer_size=100, flush_interval=1.0):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def run(self):
+        with open(self.path, "a+") as f:
+            # terminate a record cut off by a crash so it stays on its own line
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != "\n":
+                    f.write("\n")
+
+            buffer = []
+            flushed = time.monotonic()
+            running = True
+
+            while running:
+                try:
+                    record = self.queue.get(timeout=self.flush_interval)
+                    if record is None:
+                        running = False
+                    else:
+                        buffer.append(json.dumps(record, default=str) + "\n")
+                except queue.Empty:
+                    pass
+
+                if buffer and (
+                    not running
+                    or len(buffer) >= self.buffer_size
+                    or time.monotonic() - flushed >= self.flush_interval
+                ):
+                    f.writelines(buffer)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    buffer = []
+                    flushed = time.monotonic()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_records(path):
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # a record cut off by a crash mid-write
+                continue
+
+
+def read_results(path):
+    # the last record per (take, case, model): a resumed run appends the retry
+    # of a failed answer after it
+    latest = {}
+    for record in read_records(path):
+        latest[(record["take"], record["case"], record["model"])] = record
+    return list(latest.values())
+
+
+def read_take(path, take):
+    if not os.path.exists(path):
+        return []
+    return [record for record in read_results(path) if record["take"] == take]
+
+
+def is_failed(record):
+    # every retry of the LLM call failed, e.g. through a burst of rate limits
+    return record["sql"] == "--timeout--"
+
+
+def read_completed(path, take):
+    return {
+        (record["case"], record["model"])
+        for record in read_take(path, take)
+        if not is_failed(record)
+    }
+
+
+def read_stops(path, take):
+    # models the early stop retired, by take, kept next to the results
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f).get(str(take), {})
+
+
+def write_stop(path, take, model, reason):
+    stops = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            stops = json.load(f)
+    stops.setdefault(str(take), {})[model] = reason
+    with open(path + ".tmp", "w") as f:
+        json.dump(stops, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def is_correct(record):
+    # exact comparison of the whole result multiset; a truncated truth
+    # cannot be compared and a failing truth says nothing about the model
+    return (
+        record.get("truth_fingerprint") is not None
+        and not record.get("truth_truncated", False)
+        and record["fingerprint"] == record["truth_fingerprint"]
+    )
+
+
+def render_case(records):
+    # the text log format that results.py and common_errors/ parse
+    first = records[0]
+    lines = [
+        "*" * 30,
+        "",
+        f"CASE: {first['case']}",
+        f"QUESTION: {first['question']}",
+        "",
+        f"TRUE: {first['truth_sql']}",
+        "",
+    ]
+    for record in records:
+        lines += [
+            f"LLM [{record['model']}]: {record['sql']}",
+            f"MODEL: {record['model_name']}",
+            f"USAGE: {json.dumps(record['usage'])}",
+            f"ANSWER: {record['answer']} {record['truth_answer']}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def export_log(path, file=sys.stdout):
+    cases = {}
+    for record in read_results(path):
+        cases.setdefault((record["take"], record["case"]), []).append(record)
+
+    for records in cases.values():
+        print(render_case(records), file=file)
+
+
+if __name__ == "__main__":
+    # python -m nl2sql.store output/output_<experiment>.jsonl > output.log
+    export_log(sys.argv[1])
@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import fcntl
+from string import Formatter
+from types import SimpleNamespace as sn
+
+LITERAL_PATTERN = re.compile(
+    r"'((?:[^']|'')*)'|\"((?:[^\"]|\"\")*)\"|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])"
+)
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+def find_value(question, value):
+    match = re.search(r"(?<!\w)" + re.escape(value) + r"(?!\w)", question, re.I)
+    return match and match.span()
+
+
+def case_of(sql_value, question_value):
+    for transform in ["same", "upper", "lower"]:
+        if sql_value == apply_case(question_value, transform):
+            return transform
+    return "same"
+
+
+def apply_case(value, transform):
+    return {"upper": value.upper(), "lower": value.lower()}.get(transform, value)
+
+
+def abstract(question, sql, columns):
+    """Split a verified question/SQL pair into templates with entity slots.
+
+    A literal of the SQL becomes a slot when its value appears in the
+    question; literals that do not (flags, codes the question paraphrases)
+    stay part of the SQL template. Returns None when nothing can be slotted.
+    """
+    slots = []  # (question span, sql value)
+    sql_parts = []
+    position = 0
+
+    for match in LITERAL_PATTERN.finditer(sql):
+        single, double, number = match.groups()
+        if double is not None and (
+            double.upper() in columns or sql[match.start() - 1 : match.start()] == "."
+        ):
+            continue
+        value = next(v for v in (single, double, number) if v is not None)
+        value = value.replace("''", "'") if single is not None else value
+        value = value.replace('""', '"') if double is not None else value
+
+        index = next((i for i, slot in enumerate(slots) if slot[1] == value), None)
+        if index is None:
+            span = find_value(question, value)
+            if span is None or any(
+                span[0] < other[1] and other[0] < span[1] for other, _ in slots
+            ):
+                continue
+            index = len(slots)
+            slots.append((span, value))
+
+        quote = "'" if single is not None else '"' if double is not None else ""
+        sql_parts.append(
+            sql[position : match.start()].replace("{", "{{").replace("}", "}}")
+        )
+        sql_parts.append(f"{quote}{{{index}}}{quote}")
+        position = match.end()
+
+    if not slots:
+        return None
+    sql_parts.append(sql[position:].replace("{", "{{").replace("}", "}}"))
+
+    # question template with the slots numbered by their SQL order
+    question_parts = []
+    pattern_parts = []
+    position = 0
+    order = sorted(range(len(slots)), key=lambda i: slots[i][0][0])
+    for i in order:
+        (start, end), value = slots[i]
+        text = question[position:start].lower()
+        question_parts.append(text + f"{{{i}}}")
+        pattern_parts.append(re.escape(text))
+        pattern_parts.append(
+            r"(\d+(?:\.\d+)?)" if NUMBER_PATTERN.fullmatch(value) else r"(.+?)"
+        )
+        position = end
+    question_parts.append(question[position:].lower())
+    pattern_parts.append(re.escape(question[position:].lower()))
+
+    return sn(
+        question="".join(question_parts),
+        pattern="".join(pattern_parts),
+        order=order,
+        sql="".join(sql_parts),
+        cases=[case_of(value, question[s:e]) for (s, e), value in slots],
+    )
+
+
+def fill(sql_template, values, cases):
+    parts = []
+    for text, field, _, _ in Formatter().parse(sql_template):
+        parts.append(text)
+        if field is None:
+            continue
+        value = apply_case(values[int(field)], cases[int(field)])
+        quote = text[-1:]
+        parts.append(value.replace(quote, quote * 2) if quote in ("'", '"') else value)
+    return "".join(parts)
+
+
+def add(templates, scope, question, entry):
+    target = templates.setdefault(scope, {}).setdefault(
+        question, {"pattern": entry["pattern"], "order": entry["order"], "sql": {}}
+    )
+    for key, count in entry["sql"].items():
+        target["sql"][key] = target["sql"].get(key, 0) + count
+
+
+class TemplateCache:
+    """Verified SQL per question template, per model.
+
+    Questions are abstracted into templates whose entity values are slots
+    (``how many patients are younger than {0}?``). Once the same SQL
+    template has been verified ``min_support`` times for a question
+    template, new instances are answered by filling in their values.
+
+    Templates are keyed on the exact question text around the slots, so
+    they only repeat in datasets with templated questions. MIMICSQL's
+    questions are paraphrased per case: replaying the 1000 ground truth
+    pairs of take 1 gave 929 templates and 1 hit, so expect no saving there.
+    """
+
+    def __init__(self, path, columns, min_support=2):
+        self.path = path
+        self.columns = columns
+        self.min_support = min_support
+        self.templates = self.read()
+        self.learned = {}  # counts added since the file was read
+        self.compiled = {}
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def learn(self, scope, question, sql):
+        template = abstract(question, sql, self.columns)
+        if template is None:
+            return None
+        entry = {
+            "pattern": template.pattern,
+            "order": template.order,
+            "sql": {json.dumps([template.sql, template.cases]): 1},
+        }
+        add(self.templates, scope, template.question, entry)
+        add(self.learned, scope, template.question, entry)
+        return template.question
+
+    def lookup(self, scope, question):
+        for template, entry in self.templates.get(scope, {}).items():
+            key, support = max(entry["sql"].items(), key=lambda item: item[1])
+            if support < self.min_support:
+                continue
+            if template not in self.compiled:
+                self.compiled[template] = re.compile(entry["pattern"], re.I | re.S)
+            match = self.compiled[template].fullmatch(question)
+            if match is None:
+                continue
+            # groups come in question order, slots are numbered in SQL order
+            values = [None] * len(entry["order"])
+            for group, index in zip(match.groups(), entry["order"]):
+                values[index] = group
+            sql_template, cases = json.loads(key)
+            return sn(
+                template=template,
+                sql=fill(sql_template, values, cases),
+                support=support,
+            )
+        return None
+
+    def save(self):
+        # shards of a run share the file, so what this process learned is
+        # added to what is on disk now instead of replacing it
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            templates = self.read()
+            for scope, entries in self.learned.items():
+                for question, entry in entries.items():
+                    add(templates, scope, question, entry)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(templates, f, indent=2)
+            os.replace(self.path + ".tmp", self.path)
+        self.templates = templates
+        self.learned = {}
@@ -0,0 +1,121 @@
+import re
+import json
+import numpy as np
+from math import ceil
+from types import SimpleNamespace as sn
+
+WORD_PATTERN = re.compile(r"[\w'./-]+")
+# question words that never start or end a value phrase
+STOPWORDS = set("""
+    a an and are as at be by did do does for from had has have how in is it
+    its many me much of on or patient patients show that the their there
+    these they this those to was were what when where which who whose with
+    give list number name count total average maximum minimum id
+    """.split())
+
+
+def trigrams(text):
+    # padded like pg_trgm, so that short values and word starts still count
+    text = f"  {text.lower()} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def read_values(conn, columns):
+    values = {}
+    for table, table_columns in columns.items():
+        for column in table_columns:
+            values[f"{table}.{column}"] = [
+                value
+                for (value,) in conn.execute(
+                    f'SELECT DISTINCT "{column}" FROM "{table}" '
+                    f'WHERE "{column}" IS NOT NULL ORDER BY "{column}"'
+                )
+                if isinstance(value, str) and value.strip()
+            ]
+    return values
+
+
+def write_values(path, values):
+    with open(path, "w") as f:
+        json.dump(values, f)
+
+
+class ValueIndex:
+    """Trigram index over the distinct values of the DB's text columns.
+
+    Lookups score values by the Dice coefficient of their trigram sets. The
+    shared trigrams of all values are counted at once with numpy over the
+    posting lists of the phrase, so a lookup costs a fraction of a
+    millisecond instead of a LIKE scan over the table.
+    """
+
+    def __init__(self, values):
+        self.values = []  # (value, table, column)
+        self.exact = {}
+        postings = {}
+        sizes = []
+        for key, column_values in values.items():
+            table, column = key.split(".", 1)
+            for value in column_values:
+                id = len(self.values)
+                self.values.append((value, table, column))
+                self.exact.setdefault(value.lower(), []).append(id)
+                grams = trigrams(value)
+                sizes.append(len(grams))
+                for gram in grams:
+                    postings.setdefault(gram, []).append(id)
+        self.postings = {
+            gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()
+        }
+        self.sizes = np.array(sizes, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def lookup(self, phrase, k=5, min_score=0.5):
+        phrase = phrase.strip().lower()
+        if not phrase:
+            return []
+        if ids := self.exact.get(phrase):
+            return [self.match(id, 1.0) for id in ids[:k]]
+
+        grams = trigrams(phrase)
+        lists = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not lists:
+            return []
+        counts = np.bincount(np.concatenate(lists), minlength=len(self.values))
+        # dice >= min_score needs at least this many shared trigrams
+        ids = np.flatnonzero(counts >= ceil(min_score * len(grams) / 2))
+        scores = 2 * counts[ids] / (len(grams) + self.sizes[ids])
+        keep = scores >= min_score
+        ids, scores = ids[keep], scores[keep]
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [self.match(ids[i], scores[i]) for i in best]
+
+    def match(self, id, score):
+        value, table, column = self.values[id]
+        return sn(value=value, table=table, column=column, score=round(float(score), 3))
+
+    def candidates(self, question, k=10, max_words=4, min_score=0.6):
+        """Stored values matching phrases of a question, best first.
+
+        Every run of up to ``max_words`` words that neither starts nor ends
+        with a question word is looked up; a value is kept once, with the
+        best score any phrase gave it.
+        """
+        words = WORD_PATTERN.findall(question.lower())
+        best = {}
+        for start in range(len(words)):
+            if words[start] in STOPWORDS:
+                continue
+            for end in range(start + 1, min(start + max_words, len(words)) + 1):
+                if words[end - 1] in STOPWORDS:
+                    continue
+                phrase = " ".join(words[start:end])
+                for match in self.lookup(phrase, k=3, min_score=min_score):
+                    key = (match.table, match.column, match.value)
+                    if key not in best or best[key].score < match.score:
+                        best[key] = match
+        return sorted(best.values(), key=lambda match: -match.score)[:k]
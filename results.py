@@ -4,6 +4,8 @@ import json
 import pandas as pd
 from types import SimpleNamespace as sn
 from llm import models
+from nl2sql.store import read_results, is_correct
+from nl2sql.sequential import wilson, z_value
 import argparse
 
 parser = argparse.ArgumentParser(description="Obtain results")
@@ -76,9 +78,6 @@ def parse_content(file_content):
             continue
 
         lines = question.strip().split("\n")
-        true_result = None
-        model_results = []
-
         case_id = None
         for i, line in enumerate(lines):
             if line.startswith("CASE: "):
@@ -93,29 +92,13 @@ def parse_content(file_content):
                     if match := re.search(r"USAGE: (.+)", lines[i + 2]):
                         usage = json.loads(match.group(1))
 
-                    model_result = ""
-                    model_len = ""
-                    true_result = -1
-                    true_len = -1
-
-                    if match := re.search(r"ANSWER: \[(.+?)\] \[(.+?)\]", lines[i + 3]):
-                        model_result = match.group(1)
-                        true_result = match.group(2)
-                        model_results.append((model_name, model_result, true_result))
-
-                    if match := re.search(
-                        r"ANSWER: \((.+?)\) \((.+?)\) \((.+?)\) \((.+?)\)", lines[i + 3]
-                    ):
-                        model_result = match.group(1)
-                        true_result = match.group(3)
-                        model_len = match.group(2)
-                        true_len = match.group(4)
+                    predict, true = parse_answer(lines[i + 3])
 
                 result = sn(
                     model=model_name,
                     observation_id=case_id,
-                    predict=model_result + model_len,
-                    true=str(true_result) + str(true_len),
+                    predict=predict,
+                    true=true,
                     tokens_in=usage["in"] if usage["in"] > 0 else -1,
                     tokens_out=usage["out"] if usage["out"] > 0 else -1,
                 )
@@ -123,11 +106,60 @@ def parse_content(file_content):
                 sorted_predict = "".join(sorted(result.predict))
                 sorted_true = "".join(sorted(result.true))
                 result.is_correct = sorted_predict == sorted_true
+                result.scoring = "sorted_chars"
                 results.append(result)
 
     return results
 
 
+def parse_answer(line):
+    model_result = ""
+    model_len = ""
+    true_result = -1
+    true_len = -1
+
+    if match := re.search(r"ANSWER: \[(.+?)\] \[(.+?)\]", line):
+        model_result = match.group(1)
+        true_result = match.group(2)
+
+    if match := re.search(r"ANSWER: \((.+?)\) \((.+?)\) \((.+?)\) \((.+?)\)", line):
+        model_result = match.group(1)
+        true_result = match.group(3)
+        model_len = match.group(2)
+        true_len = match.group(4)
+
+    return model_result + model_len, str(true_result) + str(true_len)
+
+
+def parse_records(records):
+    results = []
+
+    for record in records:
+        if record["model"] not in included_llms:
+            continue
+
+        usage = record["usage"]
+        predict, true = parse_answer(
+            f"ANSWER: {record['answer']} {record['truth_answer']}"
+        )
+        result = sn(
+            model=record["model"],
+            observation_id=record["case"],
+            predict=predict,
+            true=true,
+            tokens_in=usage["in"] if usage["in"] > 0 else -1,
+            tokens_out=usage["out"] if usage["out"] > 0 else -1,
+            weight=record.get("weight", 1),
+        )
+
+        result.is_correct = is_correct(record)
+        # exact comparison of the result multisets
+        result.scoring = "fingerprint"
+        results.append(result)
+
+    return results
+
+
 def classify_results(results):
     classification = {}
     for model, evaluations in results.items():
@@ -289,18 +321,41 @@ if __name__ == "__main__":
     else:
         # Original processing logic
         dataframes = []
-        for i, file_name in enumerate(log_files):
-            if not file_name.endswith(".log"):
-                continue
-            with open(file_name, "r") as f:
-                file_content = f.read()
+        # a run writes output_<name>.jsonl and optionally output_<name>.log as
+        # a view of it, so both count as the same take; the log can still hold
+        # older cases from before the JSONL results existed
+        runs = sorted(
+            {
+                os.path.splitext(f)[0]
+                for f in log_files
+                if f.endswith(".log") or f.endswith(".jsonl")
+            }
+        )
+        for i, run in enumerate(runs):
+            results = []
+            if os.path.exists(run + ".jsonl"):
+                results = parse_records(read_results(run + ".jsonl"))
+            if os.path.exists(run + ".log"):
+                with open(run + ".log", "r") as f:
+                    file_content = f.read()
+
+                seen = {(r.model, r.observation_id) for r in results}
+                results += [
+                    r
+                    for r in parse_content(file_content)
+                    if (r.model, r.observation_id) not in seen
+                ]
 
-            results = parse_content(file_content)
             df = pd.DataFrame([vars(ns) for ns in results])
             df["take"] = i
             dataframes.append(df)
 
         df = pd.concat(dataframes)
+        # coreset runs weight every case by the test cases it stands for
+        if "weight" not in df:
+            df["weight"] = 1
+        df["weight"] = df["weight"].fillna(1)
+        df["weighted_correct"] = df["is_correct"] * df["weight"]
 
         model_prices = {
             model: {
@@ -310,8 +365,10 @@ if __name__ == "__main__":
             for model, info in models.items()
         }
 
+        # legacy logs are scored by their sorted first-row characters, JSONL
+        # results by fingerprint; the two are never averaged together
         result_df = (
-            df.groupby(["model", "take"])
+            df.groupby(["model", "scoring", "take"])
             .agg(
                 num_observations=("observation_id", "count"),
                 tokens_in=("tokens_in", "sum"),
@@ -320,14 +377,18 @@ if __name__ == "__main__":
                 tokens_out_count=("tokens_out", lambda x: x[x > 0].count()),
                 true_observations=("is_correct", "sum"),
                 acc=("is_correct", "mean"),
+                weight=("weight", "sum"),
+                weighted_correct=("weighted_correct", "sum"),
             )
+            .assign(acc_weighted=lambda df: df["weighted_correct"] / df["weight"])
             .reset_index()
-            .groupby("model")
+            .groupby(["model", "scoring"])
             .agg(
                 num_observations=("num_observations", "sum"),
                 true_observations=("true_observations", "sum"),
                 acc_mean=("acc", "mean"),
                 acc_stdvar=("acc", "std"),
+                acc_weighted=("acc_weighted", "mean"),
                 tokens_in=("tokens_in", "sum"),
                 tokens_in_count=("tokens_in_count", "sum"),
                 tokens_out=("tokens_out", "sum"),
@@ -337,12 +398,12 @@ if __name__ == "__main__":
             .assign(avg_tokens_out=lambda df: df["tokens_out"] / df["tokens_out_count"])
             .assign(
                 price_token_in=lambda df: df.index.map(
-                    lambda idx: model_prices[idx]["in"]
+                    lambda idx: model_prices[idx[0]]["in"]
                 )
             )
             .assign(
                 price_token_out=lambda df: df.index.map(
-                    lambda idx: model_prices[idx]["out"]
+                    lambda idx: model_prices[idx[0]]["out"]
                 )
             )
             .assign(
@@ -354,6 +415,23 @@ if __name__ == "__main__":
                 / 10**6
             )
             .assign(price_total=lambda df: df["price_in"] + df["price_out"])
+            # 95% Wilson interval over all observations of the model
+            .assign(
+                acc_low=lambda df: [
+                    wilson(correct, n, z_value(0.95))[0]
+                    for correct, n in zip(
+                        df["true_observations"], df["num_observations"]
+                    )
+                ]
+            )
+            .assign(
+                acc_high=lambda df: [
+                    wilson(correct, n, z_value(0.95))[1]
+                    for correct, n in zip(
+                        df["true_observations"], df["num_observations"]
+                    )
+                ]
+            )
             .drop(
                 columns=[
                     "tokens_in",
@@ -367,4 +445,5 @@ if __name__ == "__main__":
         print(result_df)
 
         df.to_excel(f"output/results_{args.task}.xlsx")
-        result_df.to_excel(f"output/summary_{args.task}.xlsx")
+        # model and scoring on every row, plot_*.py read the model column
+        result_df.to_excel(f"output/summary_{args.task}.xlsx", merge_cells=False)